@@ -4,6 +4,7 @@ from chalicelib.itemRoutes import item_routes
 from chalicelib.authorizers import auth_functions, admin_authorizer
 from chalicelib.userRoutes import user_routes
 from chalicelib.notificationService import notification_service
+from chalicelib.compression import add_vary_header
 
 app = Chalice(app_name='lostandfound')
 app.register_blueprint(item_routes)
@@ -12,6 +13,8 @@ app.register_blueprint(user_routes)
 app.register_blueprint(notification_service)
 
 app.api.binary_types.append("multipart/form-data")
+# Responses are compressed by API Gateway, see minimum_compression_size in .chalice/config.json
+app.register_middleware(add_vary_header, 'http')
 
 @app.route('/')
 def index():
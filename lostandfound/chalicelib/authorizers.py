@@ -1,48 +1,93 @@
 from chalice import UnauthorizedError, AuthResponse, Blueprint
-import requests
-import jwt
-from jwt.algorithms import RSAAlgorithm
+import hashlib
 import os
+import threading
+import time
 
 JWKS_URL = 'https://cognito-idp.' + os.environ.get('REGION') + '.amazonaws.com/' + os.environ.get('USER_POOL_ID') + '/.well-known/jwks.json'
 JWT_ALGORITHM = 'RS256'  # Or RS256 if using a public/private key pair
 auth_functions = Blueprint(__name__)
-# Cache for JWKS keys
-_jwks_cache = None
 
+# Seconds before the JWKS is fetched again, and minimum seconds between refreshes triggered by an unknown kid
+JWKS_TTL = int(os.environ.get('JWKS_TTL', '3600'))
+JWKS_MIN_REFRESH_INTERVAL = 30
+JWKS_TIMEOUT = 3
 
-def get_jwks():
-    """Fetches and caches the JWKS from the given URL."""
-    global _jwks_cache
-    if not _jwks_cache:
-        response = requests.get(JWKS_URL)
-        if response.status_code != 200:
+# Upper bound on verified tokens remembered per container
+TOKEN_CACHE_SIZE = 256
+
+# Cache for JWKS keys: kid -> parsed public key
+_signing_keys = {}
+_jwks_fetched_at = 0.0
+_jwks_lock = threading.Lock()
+
+# sha256(token) -> decoded claims, only holds tokens whose signature has been verified
+_verified_tokens = {}
+
+
+def refresh_signing_keys(force=False):
+    """Fetches the JWKS and indexes its parsed keys by kid, at most once per JWKS_MIN_REFRESH_INTERVAL when forced."""
+    global _signing_keys, _jwks_fetched_at
+    import requests
+    from jwt.algorithms import RSAAlgorithm
+
+    with _jwks_lock:
+        age = time.monotonic() - _jwks_fetched_at
+        if _signing_keys and age < (JWKS_MIN_REFRESH_INTERVAL if force else JWKS_TTL):
+            return _signing_keys
+
+        try:
+            response = requests.get(JWKS_URL, timeout=JWKS_TIMEOUT)
+        except requests.RequestException:
+            response = None
+        if response is None or response.status_code != 200:
+            if _signing_keys:
+                # Keep serving the keys we have, Cognito rotates keys rarely
+                print("Unable to refresh JWKS, keeping cached keys")
+                _jwks_fetched_at = time.monotonic()
+                return _signing_keys
             raise UnauthorizedError("Unable to fetch JWKS")
-        _jwks_cache = response.json()
-    return _jwks_cache
+
+        # Parse each RSA key once, instead of on every authorization
+        _signing_keys = {key['kid']: RSAAlgorithm.from_jwk(key) for key in response.json().get('keys', [])}
+        _jwks_fetched_at = time.monotonic()
+        return _signing_keys
 
 
 def get_signing_key(token):
     """Gets the signing key from the JWKS based on the token's kid."""
-    jwks = get_jwks()
+    import jwt
+
     headers = jwt.get_unverified_header(token)
     kid = headers.get('kid')
     if not kid:
         raise UnauthorizedError("Missing kid in token header")
 
-    for key in jwks.get('keys', []):
-        if key['kid'] == kid:
-            return jwt.algorithms.RSAAlgorithm.from_jwk(key)
+    signing_key = refresh_signing_keys().get(kid)
+    if signing_key is None:
+        # Unknown kid, Cognito may have rotated its keys since we last fetched them
+        signing_key = refresh_signing_keys(force=True).get(kid)
+    if signing_key is None:
+        raise UnauthorizedError("Unable to find matching key for kid")
 
-    raise UnauthorizedError("Unable to find matching key for kid")
+    return signing_key
 
 
 def decode_jwt(token):
     """Decodes the JWT token and verifies its validity using JWKS."""
+    token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    cached = _verified_tokens.get(token_hash)
+    if cached is not None:
+        if cached.get('exp', 0) > time.time():
+            return cached
+        _verified_tokens.pop(token_hash, None)
+
+    # PyJWT pulls in cryptography, only load it for authorized routes
+    import jwt
+
     try:
         signing_key = get_signing_key(token)
         decoded_token = jwt.decode(token, signing_key, algorithms=['RS256'], options={"verify_aud": False})
-        return decoded_token
     except jwt.ExpiredSignatureError:
         raise UnauthorizedError("Token has expired")
     except jwt.InvalidTokenError:
@@ -50,6 +95,13 @@ def decode_jwt(token):
     except UnauthorizedError:
         raise UnauthorizedError("Unable to decode token")
 
+    if 'exp' in decoded_token:
+        if len(_verified_tokens) >= TOKEN_CACHE_SIZE:
+            # Evict the oldest entry, dicts keep insertion order
+            _verified_tokens.pop(next(iter(_verified_tokens)), None)
+        _verified_tokens[token_hash] = decoded_token
+    return decoded_token
+
 @auth_functions.authorizer()
 def admin_authorizer(auth_request):
     """Authorizer to validate JWT tokens and check user group membership."""
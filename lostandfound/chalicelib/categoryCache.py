@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+import time
+from .connectHelper import get_connection
+from .helpers import json_serial, make_etag
+
+# Seconds a loaded category table stays fresh in a warm container
+CATEGORY_CACHE_TTL = int(os.environ.get('CATEGORY_CACHE_TTL', '300'))
+
+# Minimum seconds between reloads triggered by lookup misses, so unknown names cannot hammer the database
+MISS_RELOAD_INTERVAL = 10
+
+_snapshot = None
+_loaded_at = 0.0
+_lock = threading.Lock()
+
+
+def _load():
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT * FROM category")
+        rows = cursor.fetchall()
+
+    body = json.dumps({"category": rows}, default=json_serial)
+    return {
+        "rows": rows,
+        "names": [row['name'] for row in rows],
+        "by_name": {row['name'].lower(): row['id'] for row in rows},
+        "by_id": {row['id']: row['name'] for row in rows},
+        "body": body,
+        "etag": make_etag(body)
+    }
+
+
+def get_categories(refresh=False):
+    """
+    Returns the cached category table, reloading it once the TTL has passed.
+    :param refresh: Reload from the database even if the cache is still fresh.
+    :return: Dict with rows, names, by_name/by_id indexes, the serialized body and its ETag.
+    """
+    global _snapshot, _loaded_at
+    with _lock:
+        if refresh or _snapshot is None or time.monotonic() - _loaded_at > CATEGORY_CACHE_TTL:
+            _snapshot = _load()
+            _loaded_at = time.monotonic()
+        return _snapshot
+
+
+def invalidate_categories():
+    """Drops the cached table so the next lookup reads the database."""
+    global _snapshot
+    with _lock:
+        _snapshot = None
+
+
+def get_category_id(name):
+    """Resolves a category name (case-insensitive) to its id, reloading once on a miss."""
+    if not name:
+        return None
+    category_id = get_categories()["by_name"].get(name.lower())
+    if category_id is None:
+        # The category may have been added after the cache was loaded
+        category_id = _reload_after_miss()["by_name"].get(name.lower())
+    return category_id
+
+
+def get_category_name(category_id):
+    """Resolves a category id to its name, reloading once on a miss."""
+    name = get_categories()["by_id"].get(category_id)
+    if name is None:
+        name = _reload_after_miss()["by_id"].get(category_id)
+    return name
+
+
+def _reload_after_miss():
+    return get_categories(refresh=time.monotonic() - _loaded_at > MISS_RELOAD_INTERVAL)
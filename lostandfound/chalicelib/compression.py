@@ -0,0 +1,16 @@
+def add_vary_header(event, get_response):
+    """
+    HTTP middleware that marks every response as varying by Accept-Encoding. API Gateway compresses
+    responses above minimum_compression_size (.chalice/config.json) for clients that accept gzip or deflate,
+    so shared caches must keep compressed and uncompressed copies apart, including for small responses.
+    """
+    response = get_response(event)
+
+    for name, value in response.headers.items():
+        if name.lower() == 'vary':
+            if 'accept-encoding' not in value.lower():
+                response.headers[name] = f"{value}, Accept-Encoding"
+            return response
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
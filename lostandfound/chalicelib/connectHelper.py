@@ -1,23 +1,102 @@
-import boto3
 import pymysql
 import os
-
-ssm_client = boto3.client('ssm')
+import threading
+from contextlib import contextmanager
+from .lazyRegistry import get_ssm_parameters
 
 app_name = os.environ.get('APP_NAME')
 
-# Batch get parameters from SSM
-response = ssm_client.get_parameters(Names=[f'/{app_name}/rds_host', f'/{app_name}/rds_user', f'/{app_name}/rds_password', f'/{app_name}/db_name'], WithDecryption=True)
-ssm_dict = {param['Name']: param['Value'] for param in response['Parameters']}
+# Maximum number of idle connections kept alive per warm container
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+
+SSM_PARAMETER_NAMES = [f'/{app_name}/rds_host', f'/{app_name}/rds_user', f'/{app_name}/rds_password', f'/{app_name}/db_name']
+
+# MySQL error code for rejected credentials, e.g. after a password rotation
+ER_ACCESS_DENIED_ERROR = 1045
+
+# Idle connections that survive between invocations of the same container
+_idle_connections = []
+_pool_lock = threading.Lock()
+
 
-def create_connection():
-    # RDS connection details from environment variables
+def create_connection(refresh_config=False):
+    # RDS connection details, fetched from SSM on first use
+    ssm_dict = get_ssm_parameters(SSM_PARAMETER_NAMES, refresh=refresh_config)
     HOST = ssm_dict[f'/{app_name}/rds_host']
     USER = ssm_dict[f'/{app_name}/rds_user']
     PASSWORD = ssm_dict[f'/{app_name}/rds_password']
     DB_NAME = ssm_dict[f'/{app_name}/db_name']
 
-    connection = pymysql.connect(host=HOST, user=USER, password=PASSWORD, database=DB_NAME, charset='utf8mb4',
-                                 cursorclass=pymysql.cursors.DictCursor, autocommit=True)
+    try:
+        connection = pymysql.connect(host=HOST, user=USER, password=PASSWORD, database=DB_NAME, charset='utf8mb4',
+                                     cursorclass=pymysql.cursors.DictCursor, autocommit=True)
+    except pymysql.err.OperationalError as e:
+        # Credentials may have rotated since they were cached, retry once with fresh values
+        if refresh_config or e.args[0] != ER_ACCESS_DENIED_ERROR:
+            raise
+        return create_connection(refresh_config=True)
 
     return connection
+
+
+def _checkout():
+    """Takes an idle connection from the pool, or opens a new one if none is usable."""
+    while True:
+        with _pool_lock:
+            connection = _idle_connections.pop() if _idle_connections else None
+
+        if connection is None:
+            return create_connection()
+
+        try:
+            # Cheap round trip that also reconnects after an RDS failover or idle timeout
+            connection.ping(reconnect=True)
+            return connection
+        except pymysql.MySQLError as e:
+            print(f"Discarding stale database connection: {e}")
+            _close_quietly(connection)
+
+
+def _release(connection):
+    """Returns a healthy connection to the pool, closing it if the pool is already full."""
+    if not connection.open:
+        return
+
+    with _pool_lock:
+        if len(_idle_connections) < POOL_SIZE:
+            _idle_connections.append(connection)
+            return
+
+    _close_quietly(connection)
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+@contextmanager
+def get_connection():
+    """
+    Context manager that hands out a validated connection reused across warm invocations.
+    The connection is always released back to the pool (or closed if it broke) on exit.
+    """
+    connection = _checkout()
+    try:
+        yield connection
+    except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+        # The connection itself is suspect, never hand it out again
+        _close_quietly(connection)
+        raise
+    except Exception:
+        # Undo any explicit transaction left open by the failed block
+        try:
+            connection.rollback()
+        except pymysql.MySQLError:
+            _close_quietly(connection)
+        _release(connection)
+        raise
+    else:
+        _release(connection)
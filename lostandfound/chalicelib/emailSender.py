@@ -0,0 +1,133 @@
+import json
+import os
+import random
+import threading
+import time
+from .helpers import json_serial
+from .lazyRegistry import get_client
+
+# SES accepts at most 50 destinations per bulk send
+MAX_DESTINATIONS_PER_SEND = 50
+
+# Account sending rate in messages per second, every destination counts as one message
+SES_SEND_RATE = float(os.environ.get('SES_SEND_RATE', '14'))
+
+# Retries for throttled sends, with exponential backoff starting at RETRY_BASE_DELAY seconds
+MAX_SEND_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.5
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'MaxSendingRateExceeded')
+
+NEW_ITEMS_TEMPLATE = {
+    'TemplateName': 'LostAndFoundNewItems',
+    'SubjectPart': 'Lost and Found Notification - {{title}}',
+    'TextPart': (
+        "{{title}} to category:\n\n"
+        "{{#each items}}Name: {{name}}\nDescription: {{description}}\nLocation: {{location}}\nFound at: {{found_at}}\n\n{{/each}}"
+        "Please check the NYP Lost and Found website for more details: https://main.dthcvv5pro4em.amplifyapp.com/\n"
+    )
+}
+
+DIGEST_TEMPLATE = {
+    'TemplateName': 'LostAndFoundDigest',
+    'SubjectPart': 'Lost and Found Digest - {{title}}',
+    'TextPart': (
+        "{{title}} in the categories you follow:\n\n"
+        "{{#each items}}Category: {{category}}\nName: {{name}}\nDescription: {{description}}\n"
+        "Location: {{location}}\nFound at: {{found_at}}\n\n{{/each}}"
+        "Please check the NYP Lost and Found website for more details: https://main.dthcvv5pro4em.amplifyapp.com/\n"
+    )
+}
+
+# Token bucket shared by all sends in this container, tokens may go negative to pay for a large chunk
+_tokens = SES_SEND_RATE
+_last_refill = time.monotonic()
+_bucket_lock = threading.Lock()
+
+_templates_ready = set()
+
+
+def acquire_send_quota(count):
+    """Blocks until count messages can be sent without exceeding SES_SEND_RATE."""
+    global _tokens, _last_refill
+    with _bucket_lock:
+        now = time.monotonic()
+        _tokens = min(SES_SEND_RATE, _tokens + (now - _last_refill) * SES_SEND_RATE)
+        _last_refill = now
+        _tokens -= count
+        wait = -_tokens / SES_SEND_RATE if _tokens < 0 else 0
+
+    if wait:
+        time.sleep(wait)
+
+
+def ensure_template(template):
+    """Creates or updates the SES template once per container."""
+    name = template['TemplateName']
+    if name in _templates_ready:
+        return
+
+    ses = get_client('ses')
+    try:
+        ses.update_template(Template=template)
+    except ses.exceptions.TemplateDoesNotExistException:
+        ses.create_template(Template=template)
+    _templates_ready.add(name)
+
+
+def _send_with_retry(send, **kwargs):
+    for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+        try:
+            return send(**kwargs)
+        except get_client('ses').exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLING_ERRORS or attempt == MAX_SEND_ATTEMPTS:
+                raise
+            delay = RETRY_BASE_DELAY * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            print(f"SES throttled, retrying in {delay:.2f}s (attempt {attempt})")
+            time.sleep(delay)
+
+
+def _destination(email, recipient_data):
+    destination = {'Destination': {'ToAddresses': [email]}}
+    if recipient_data and email in recipient_data:
+        destination['ReplacementTemplateData'] = json.dumps(recipient_data[email], default=json_serial)
+    return destination
+
+
+def send_templated_bulk(template, emails, template_data, recipient_data=None):
+    """
+    Sends a templated email to each address separately, in chunks of MAX_DESTINATIONS_PER_SEND.
+    :param template: Template definition, created in SES on first use.
+    :param emails: Recipient addresses, each one only sees its own address.
+    :param template_data: Data rendered into the template for every recipient.
+    :param recipient_data: Optional dict of email -> data that replaces template_data for that recipient.
+    :return: Dict of email -> {'status': 'Success' or the SES error, 'message_id'}.
+    """
+    ensure_template(template)
+    ses = get_client('ses')
+    outcomes = {}
+
+    # Drop duplicates but keep the order
+    emails = list(dict.fromkeys(emails))
+    for start in range(0, len(emails), MAX_DESTINATIONS_PER_SEND):
+        chunk = emails[start:start + MAX_DESTINATIONS_PER_SEND]
+        acquire_send_quota(len(chunk))
+        try:
+            response = _send_with_retry(
+                ses.send_bulk_templated_email,
+                Source=os.environ.get('SES_EMAIL'),
+                Template=template['TemplateName'],
+                DefaultTemplateData=json.dumps(template_data, default=json_serial),
+                Destinations=[_destination(email, recipient_data) for email in chunk]
+            )
+        except ses.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            print(f"Bulk send failed for {len(chunk)} recipients: {code}")
+            outcomes.update({email: {'status': code, 'message_id': None} for email in chunk})
+            continue
+
+        for email, status in zip(chunk, response['Status']):
+            outcomes[email] = {'status': status['Status'], 'message_id': status.get('MessageId')}
+
+    failed = [email for email, outcome in outcomes.items() if outcome['status'] != 'Success']
+    print(f"Sent {len(outcomes) - len(failed)} of {len(outcomes)} emails, failed: {failed}")
+    return outcomes
@@ -1,4 +1,16 @@
-from datetime import date, datetime, timedelta
+import base64
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from email.utils import format_datetime, parsedate_to_datetime
+from chalice import Response
+
+# Upper bound on threads used for concurrent network calls within one request
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '4'))
+
 
 def json_serial(obj):
     """JSON serializer for objects not serializable by default json code"""
@@ -11,5 +23,162 @@ def json_serial(obj):
         hours, remainder = divmod(seconds, 3600)
         minutes, seconds = divmod(remainder, 60)
         return f"{hours:02}:{minutes:02}:{seconds:02}"
+    elif isinstance(obj, Decimal):
+        # DECIMAL and SUM()/AVG() results, keep whole numbers as integers
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
 
     raise TypeError("Type %s not serializable" % type(obj))
+
+
+def encode_cursor(values):
+    """Encodes keyset pagination values into an opaque URL-safe cursor"""
+
+    raw = json.dumps(values, default=json_serial, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor produced by encode_cursor, raising ValueError if it is malformed"""
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def parse_datetime_param(value, end_of_day=False):
+    """Parses an ISO date or datetime query parameter, a bare date can be widened to the end of that day"""
+
+    try:
+        if len(value) == 10:
+            parsed = datetime.combine(date.fromisoformat(value), datetime.min.time())
+            return parsed + timedelta(days=1, microseconds=-1) if end_of_day else parsed
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid date: {value}")
+
+
+def map_concurrently(func, items, max_workers=MAX_WORKERS):
+    """Applies func to every item on a bounded thread pool, returning results in the order of items"""
+
+    items = list(items)
+    if len(items) <= 1:
+        # Not worth spinning up a pool for a single call
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+class RawJSON(str):
+    """Already-encoded JSON text that encode_json embeds verbatim instead of encoding again"""
+
+
+def _contains_raw_json(obj):
+    if isinstance(obj, RawJSON):
+        return True
+    if isinstance(obj, dict):
+        return any(_contains_raw_json(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_contains_raw_json(value) for value in obj)
+    return False
+
+
+def encode_json(obj, default=json_serial):
+    """Encodes obj to JSON once, splicing in RawJSON values at any depth verbatim"""
+
+    if isinstance(obj, RawJSON):
+        return obj
+    if not _contains_raw_json(obj):
+        return json.dumps(obj, default=default, separators=(',', ':'))
+    if isinstance(obj, dict):
+        return '{' + ','.join(json.dumps(str(key)) + ':' + encode_json(value, default) for key, value in obj.items()) + '}'
+    return '[' + ','.join(encode_json(value, default) for value in obj) + ']'
+
+
+def encode_row(row, json_columns=()):
+    """
+    Encodes a DB row as a JSON object. Columns in json_columns hold JSON text and are embedded
+    as-is rather than as strings, so clients get arrays instead of text they have to parse again.
+    """
+
+    raw = {column: row[column] for column in json_columns if column in row}
+    encoded = json.dumps({key: value for key, value in row.items() if key not in raw},
+                         default=json_serial, separators=(',', ':'))
+    if raw:
+        spliced = ','.join(json.dumps(column) + ':' + (value if value else 'null') for column, value in raw.items())
+        encoded = encoded[:-1] + (',' if len(encoded) > 2 else '') + spliced + '}'
+    return RawJSON(encoded)
+
+
+def iter_encode_rows(rows, json_columns=()):
+    """
+    Encodes DB rows as a JSON array in chunks, one row per chunk, so large result sets are never
+    held as intermediate Python structures. See encode_row for json_columns.
+    """
+
+    yield '['
+    for index, row in enumerate(rows):
+        encoded = encode_row(row, json_columns)
+        yield encoded if index == 0 else ',' + encoded
+    yield ']'
+
+
+def encode_rows(rows, json_columns=()):
+    """Encodes DB rows as a JSON array string, see iter_encode_rows"""
+
+    return RawJSON(''.join(iter_encode_rows(rows, json_columns)))
+
+
+def json_response(body, status_code=200, headers=None, default=json_serial):
+    """Builds a Response whose body is encoded exactly once, instead of Chalice re-encoding a parsed copy"""
+
+    return Response(
+        body=encode_json(body, default),
+        status_code=status_code,
+        headers={'Content-Type': 'application/json', **(headers or {})}
+    )
+
+
+def make_etag(body):
+    """Strong ETag for a response body, hash the exact text that is sent so the two can never disagree"""
+
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def http_date(value):
+    """Formats a naive UTC datetime from the database as an HTTP date, e.g. for Last-Modified"""
+
+    return format_datetime(value.replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+
+
+def is_not_modified(headers, etag, last_modified=None):
+    """
+    Evaluates conditional request headers against the current representation, letting clients revalidate
+    their copy with a 304 instead of downloading it again.
+    :param headers: Request headers.
+    :param etag: Current ETag.
+    :param last_modified: Current modification time as a naive UTC datetime, None if unknown.
+    :return: True if the client's copy is still current and a 304 can be sent.
+    """
+
+    if_none_match = headers.get('if-none-match')
+    if if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        candidates = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in candidates or etag in candidates or 'W/' + etag in candidates
+
+    if_modified_since = headers.get('if-modified-since')
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= since
+
+    return False
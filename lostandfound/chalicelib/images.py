@@ -0,0 +1,204 @@
+import io
+import json
+import os
+import urllib.parse as urllib
+from .connectHelper import get_connection
+from .helpers import map_concurrently
+from .lazyRegistry import get_client
+
+# Images above this size are downscaled before being sent to Rekognition
+REKOGNITION_DOWNSCALE_BYTES = 1024 * 1024
+REKOGNITION_MAX_DIMENSION = 1600
+
+# Largest non-JPEG image decoded at full size. JPEGs are scaled down while decoding, other formats are not, so a
+# small PNG can still expand to hundreds of MB of pixels; several decode at once on a 512 MB Lambda
+MAX_FULL_DECODE_PIXELS = 8 * 1000 * 1000
+
+# Derivatives generated next to every original upload, name -> longest side in pixels
+DERIVATIVE_SIZES = {'thumbnail': 320, 'medium': 1024}
+DERIVATIVE_QUALITY = 80
+
+
+def open_oriented_image(file_content, max_dimension):
+    """
+    Decodes an image once for resizing, upright according to its EXIF orientation.
+    :param file_content: Validated image bytes.
+    :param max_dimension: Largest size any caller will render, lets JPEG decoding scale down early.
+    :return: RGB Pillow image.
+    :raises ValueError: For non-JPEG images above MAX_FULL_DECODE_PIXELS.
+    """
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(file_content))
+    if image.format != 'JPEG' and image.width * image.height > MAX_FULL_DECODE_PIXELS:
+        raise ValueError(f"{image.format} image of {image.width}x{image.height} is too large to decode")
+    # For JPEGs, let the decoder scale down during decoding instead of after a full decode
+    image.draft('RGB', (max_dimension, max_dimension))
+    image = ImageOps.exif_transpose(image)
+    return image.convert('RGB')
+
+
+def encode_image(image, max_dimension, image_format):
+    """Renders a copy of the image that fits within max_dimension in the given format."""
+    resized = image.copy()
+    resized.thumbnail((max_dimension, max_dimension))
+
+    output = io.BytesIO()
+    resized.save(output, format=image_format, quality=DERIVATIVE_QUALITY)
+    return output.getvalue()
+
+
+def prepare_rekognition_bytes(file_content, image=None):
+    """
+    Downscales large images before they are sent to Rekognition. Labels do not need full
+    resolution, and a smaller payload uploads faster and stays under the 5 MB Bytes limit.
+    :param file_content: Original image bytes.
+    :param image: Already decoded image from open_oriented_image, if available.
+    :return: Bytes to send to Rekognition.
+    """
+    if len(file_content) <= REKOGNITION_DOWNSCALE_BYTES:
+        return file_content
+
+    try:
+        if image is None:
+            image = open_oriented_image(file_content, REKOGNITION_MAX_DIMENSION)
+        downscaled = encode_image(image, REKOGNITION_MAX_DIMENSION, 'JPEG')
+        print(f"Downscaled image for Rekognition from {len(file_content)} to {len(downscaled)} bytes")
+        return downscaled
+    except Exception as e:
+        print(f"Could not downscale image for Rekognition, sending original: {str(e)}")
+        return file_content
+
+
+def derivative_format():
+    """Returns (Pillow format, content type, extension) for derivatives, WebP when Pillow supports it."""
+    from PIL import features
+
+    if features.check('webp'):
+        return 'WEBP', 'image/webp', 'webp'
+    return 'JPEG', 'image/jpeg', 'jpg'
+
+
+def derivative_key(s3_key, size_name, extension):
+    """
+    Maps an original's key to the key of one of its derivatives,
+    e.g. items/<uuid>_bag.jpg -> items/thumbnail/<uuid>_bag.webp.
+    """
+    stem = os.path.splitext(s3_key[len('items/'):])[0]
+    return f"items/{size_name}/{stem}.{extension}"
+
+
+def store_image(s3_key, file_content, content_type, image, upload_original=True):
+    """
+    Uploads an original image together with its resized derivatives.
+    :param image: Decoded image from open_oriented_image, or None to store only the original.
+    :param upload_original: False when the original is already in S3 (presigned uploads).
+    :return: (image_url, derivative_urls) where derivative_urls maps each DERIVATIVE_SIZES name to a URL or None.
+    """
+    if upload_original:
+        image_url = upload_item_image(s3_key, file_content, content_type)
+    else:
+        image_url = object_url(s3_key)
+    derivative_urls = dict.fromkeys(DERIVATIVE_SIZES)
+
+    if image is None:
+        return image_url, derivative_urls
+
+    image_format, derivative_content_type, extension = derivative_format()
+    for size_name, max_dimension in DERIVATIVE_SIZES.items():
+        try:
+            data = encode_image(image, max_dimension, image_format)
+            # Keys are unique per upload, so derivatives never change and can be cached indefinitely
+            derivative_urls[size_name] = upload_item_image(
+                derivative_key(s3_key, size_name, extension), data, derivative_content_type,
+                cache_control='public, max-age=31536000, immutable'
+            )
+        except Exception as e:
+            print(f"Failed to create {size_name} derivative for {s3_key}: {str(e)}")
+
+    return image_url, derivative_urls
+
+
+def decode_upload(file_content):
+    """Decodes a validated upload for derivatives and Rekognition, or returns None if it cannot be decoded."""
+    try:
+        return open_oriented_image(file_content, max(REKOGNITION_MAX_DIMENSION, *DERIVATIVE_SIZES.values()))
+    except Exception as e:
+        print(f"Could not decode image for resizing: {str(e)}")
+        return None
+
+
+def upload_item_image(s3_key, file_content, content_type, cache_control=None):
+    """
+    Uploads an image to the items bucket.
+    :return: Public URL of the uploaded object.
+    """
+    s3_bucket = os.environ['S3_BUCKET_NAME']
+    print(f"Uploading file to S3: Bucket = {s3_bucket}, Key = {s3_key}")
+
+    extra_args = {'CacheControl': cache_control} if cache_control else {}
+    get_client('s3').put_object(
+        Bucket=s3_bucket,
+        Key=s3_key,
+        Body=file_content,
+        ContentType=content_type,
+        **extra_args
+    )
+
+    image_url = object_url(s3_key)
+    print(f"Uploaded image URL: {image_url}")
+    return image_url
+
+
+def object_url(s3_key):
+    """Public URL of an object in the items bucket."""
+    return f"https://{os.environ['S3_BUCKET_NAME']}.s3.amazonaws.com/{urllib.quote(s3_key)}"
+
+
+def object_key(image_url):
+    """Inverse of object_url, returns the S3 key of an items bucket URL."""
+    return urllib.unquote(urllib.urlparse(image_url).path.lstrip('/'))
+
+
+def fill_item_derivatives(item_id):
+    """
+    Generates the derivatives an item's images are missing, e.g. for presigned uploads, which are finalized
+    without pulling the image into the request. Runs in the SQS worker.
+    :param item_id: Item to complete.
+    :return: True if the item was updated, False if it was missing or had nothing to fill.
+    """
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT image_url, thumbnail_url, medium_url FROM items WHERE id = %s", (item_id,))
+        item = cursor.fetchone()
+
+    if item is None:
+        return False
+
+    image_urls = json.loads(item['image_url'] or '[]')
+    derivatives = {}
+    for size_name in DERIVATIVE_SIZES:
+        urls = json.loads(item[f"{size_name}_url"] or '[]')
+        # Rows from before the derivative columns existed have no entries at all
+        derivatives[size_name] = urls + [None] * (len(image_urls) - len(urls))
+
+    missing = [index for index in range(len(image_urls))
+               if any(derivatives[size_name][index] is None for size_name in DERIVATIVE_SIZES)]
+    if not missing:
+        return False
+
+    def generate(index):
+        s3_key = object_key(image_urls[index])
+        content = get_client('s3').get_object(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_key)['Body'].read()
+        return store_image(s3_key, content, None, decode_upload(content), upload_original=False)[1]
+
+    for index, derivative_urls in zip(missing, map_concurrently(generate, missing)):
+        for size_name in DERIVATIVE_SIZES:
+            derivatives[size_name][index] = derivatives[size_name][index] or derivative_urls[size_name]
+
+    with get_connection() as conn, conn.cursor() as cursor:
+        # Guard on the images so an update that replaced them meanwhile is not overwritten
+        cursor.execute(
+            "UPDATE items SET thumbnail_url = %s, medium_url = %s WHERE id = %s AND image_url = %s",
+            (json.dumps(derivatives['thumbnail']), json.dumps(derivatives['medium']), item_id, item['image_url'])
+        )
+        return cursor.rowcount == 1
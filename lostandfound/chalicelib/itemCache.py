@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from .connectHelper import get_connection
+from .helpers import encode_json, encode_row, http_date, make_etag
+from .itemFields import ITEM_COLUMNS, ITEM_JSON_COLUMNS
+
+# Maximum number of items kept per warm container, least recently used ones are evicted first
+ITEM_CACHE_SIZE = int(os.environ.get('ITEM_CACHE_SIZE', '256'))
+
+# Seconds a cached item stays fresh. Writes in this container invalidate it immediately, the TTL bounds how
+# long other containers (and the label worker) can serve an older copy
+ITEM_CACHE_TTL = int(os.environ.get('ITEM_CACHE_TTL', '30'))
+
+# item id -> (loaded at, entry), in least to most recently used order
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+# Bumped by every invalidation, a load that overlapped one may have read the old row and is not stored
+_generation = 0
+
+
+def _load(item_id):
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(f"SELECT {', '.join(ITEM_COLUMNS)} FROM items WHERE id = %s", (item_id,))
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    body = encode_json({"item": encode_row(row, ITEM_JSON_COLUMNS)})
+    return {
+        "body": body,
+        "etag": make_etag(body),
+        "updated_at": row.get('updated_at'),
+        "last_modified": http_date(row['updated_at']) if row.get('updated_at') else None
+    }
+
+
+def get_item_entry(item_id):
+    """
+    Returns the serialized item, reading it from the database on a miss or once the TTL has passed.
+    :param item_id: Item id.
+    :return: Dict with the response body, its ETag, updated_at and the Last-Modified header value,
+             None if the item does not exist. Missing items are not cached.
+    """
+    now = time.monotonic()
+    with _lock:
+        generation = _generation
+        cached = _entries.get(item_id)
+        if cached is not None and now - cached[0] <= ITEM_CACHE_TTL:
+            _entries.move_to_end(item_id)
+            return cached[1]
+
+    # Load outside the lock so a slow query does not block reads of other items
+    entry = _load(item_id)
+
+    with _lock:
+        if entry is None:
+            _entries.pop(item_id, None)
+            return None
+        if generation != _generation:
+            return entry
+        _entries[item_id] = (now, entry)
+        _entries.move_to_end(item_id)
+        while len(_entries) > ITEM_CACHE_SIZE:
+            _entries.popitem(last=False)
+    return entry
+
+
+def invalidate_items(item_ids):
+    """Drops the given items so the next read goes to the database."""
+    global _generation
+    with _lock:
+        _generation += 1
+        for item_id in item_ids:
+            if str(item_id).isdigit():
+                _entries.pop(int(item_id), None)
@@ -0,0 +1,34 @@
+# Columns of the items table that can be requested through the fields= query parameter
+ITEM_COLUMNS = ('id', 'item_name', 'description', 'location', 'found_at', 'image_url', 'thumbnail_url', 'medium_url',
+                'category', 'brand', 'status', 'labels', 'labels_status', 'created_at', 'updated_at')
+
+# Columns holding JSON text, returned to clients as parsed arrays
+ITEM_JSON_COLUMNS = ('image_url', 'thumbnail_url', 'medium_url', 'labels')
+
+# Named projections, "summary" carries what a list card shows. image_url is kept as the fallback for images
+# without a thumbnail, i.e. rows from before migration 003, failed derivatives and pending presigned uploads
+ITEM_PROJECTIONS = {
+    'summary': ('id', 'item_name', 'category', 'status', 'location', 'found_at', 'image_url', 'thumbnail_url',
+                'updated_at'),
+    'full': ITEM_COLUMNS
+}
+
+
+def parse_fields(value, default):
+    """
+    Resolves a fields= query parameter to the columns to select.
+    :param value: A projection name from ITEM_PROJECTIONS or a comma-separated list of columns, may be empty.
+    :param default: Projection name used when value is empty.
+    :return: Tuple of column names in ITEM_COLUMNS order, always including id.
+    """
+    value = (value or '').strip() or default
+    if value in ITEM_PROJECTIONS:
+        return ITEM_PROJECTIONS[value]
+
+    requested = {field.strip() for field in value.split(',') if field.strip()}
+    unknown = requested - set(ITEM_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    # Only whitelisted names ever reach the SQL text
+    return tuple(column for column in ITEM_COLUMNS if column in requested or column == 'id')
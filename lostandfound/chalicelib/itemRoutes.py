@@ -1,34 +1,82 @@
 import uuid
+from datetime import datetime
 
-from botocore.compat import file_type
 from chalice import Blueprint, BadRequestError, Response
 import json
-import boto3
 import os
 import traceback
-import urllib.parse as urllib
-from .connectHelper import create_connection
-from requests_toolbelt.multipart import decoder
-from .helpers import json_serial
-from .notificationService import create_notification
-from PIL import Image
+from .authorizers import admin_authorizer
+from .categoryCache import get_categories, get_category_id, get_category_name
+from .connectHelper import get_connection
+from .helpers import json_response, encode_json, encode_row, encode_rows, map_concurrently, encode_cursor, decode_cursor, \
+    parse_datetime_param, http_date, is_not_modified, make_etag
+from .itemCache import get_item_entry, invalidate_items
+from .itemFields import ITEM_JSON_COLUMNS, parse_fields
+from .images import DERIVATIVE_SIZES, decode_upload, object_key, object_url, prepare_rekognition_bytes, store_image
+from .lazyRegistry import get_client
+from .labeling import ASYNC_LABELING, LABELS_DONE, LABELS_PENDING, MIN_CATEGORY_SCORE, REKOGNITION_MAX_S3_BYTES, \
+    call_amazon_rekognition, choose_category, get_category_matcher, label_names, rank_categories
+from .notificationService import create_notification, create_derivative_job, create_label_job
 import io
 import re
 import base64
 
 item_routes = Blueprint(__name__)
-s3 = boto3.client('s3')
 
 SUPPORTED_IMAGE_FORMATS = ['jpeg', 'png', 'jpg']
 
-from PIL import Image, UnidentifiedImageError
-import io
-import re
-import base64
+# Page size bounds for GET /items
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
 
-SUPPORTED_IMAGE_FORMATS = ['jpeg', 'png', 'jpg']
+# Columns covered by the ft_items_search FULLTEXT index, order must match the index definition
+SEARCH_COLUMNS = "item_name, description, location, brand, labels_text"
+MAX_SEARCH_QUERY_LENGTH = 200
+
+# Upload limits checked against the image header, before any full decode
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', str(10 * 1024 * 1024)))
+# Presigned uploads never pass through the Lambda, so they can be larger than multipart ones
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(50 * 1024 * 1024)))
+MAX_IMAGE_DIMENSION = int(os.environ.get('MAX_IMAGE_DIMENSION', '8000'))
+# 24 MP covers 12 MP phone photos with room to spare while keeping decodes within the Lambda's memory
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', str(24 * 1000 * 1000)))
+
+# Presigned direct-to-S3 uploads
+UPLOAD_PREFIX = 'items/uploads/'
+UPLOAD_URL_EXPIRY = 900
+MAX_UPLOAD_FILES = 10
+UPLOAD_CONTENT_TYPES = {'jpeg': 'image/jpeg', 'jpg': 'image/jpeg', 'png': 'image/png'}
+UPLOAD_KEY_PATTERN = re.compile(r'^items/uploads/[0-9a-f-]{36}_(?P<filename>[A-Za-z0-9._-]+)$')
+
+# Bytes fetched from a presigned upload to validate it, enough for the image header including EXIF and ICC data
+UPLOAD_HEADER_BYTES = 256 * 1024
+
+BASE64_HEADER_PATTERN = re.compile(rb'^data:image/[a-zA-Z]+;base64,')
+
+# Items accepted by one /items/bulk request
+MAX_BULK_ITEMS = 500
+
+# Status transitions of the bulk claim/unclaim actions, action -> (expected status, new status)
+BULK_STATUS_ACTIONS = {'claim': ('unclaimed', 'claimed'), 'unclaim': ('claimed', 'unclaimed')}
+BULK_ACTIONS = ('claim', 'unclaim', 'delete', 'recategorize')
+
+# S3 DeleteObjects accepts at most 1000 keys per call
+S3_DELETE_BATCH_SIZE = 1000
+
+def validate_image(file_content, filename=None, total_size=None):
+    """
+    Validates an uploaded image by reading only its header, so oversized or malicious files
+    are rejected before anything is decoded.
+    :param file_content: Raw bytes from the upload, optionally a base64 data URL.
+    :param filename: Original filename, used to check the extension.
+    :param total_size: Size of the whole object when file_content only holds its first bytes (presigned uploads).
+    :return: Dict with valid, error, format, width, height and the (base64-decoded) content.
+    """
+    # Pillow is only needed on the upload paths, keep it out of the cold start
+    from PIL import Image, UnidentifiedImageError
+
+    result = {'valid': False, 'error': None, 'format': None, 'width': None, 'height': None, 'content': file_content}
 
-def validate_image(file_content, filename=None):
     try:
         # Step 1: Check the file extension if provided
         if filename:
@@ -37,161 +85,405 @@ def validate_image(file_content, filename=None):
                 raise ValueError(f"Unsupported image format: {extension}")
 
         # Step 2: Check for common encoding issues (base64 headers)
-        if is_base64_encoded(file_content):
+        if total_size is None and is_base64_encoded(file_content):
             print("Base64 header detected, decoding...")
             file_content = decode_base64_image(file_content)
+            result['content'] = file_content
+
+        # Step 3: Enforce the byte limit before handing anything to Pillow
+        size, limit = (len(file_content), MAX_IMAGE_BYTES) if total_size is None else (total_size, MAX_UPLOAD_BYTES)
+        if size > limit:
+            raise ValueError(f"Image is {size} bytes, the limit is {limit}")
 
-        # Step 3: Verify that the image can be opened using Pillow
+        # Step 4: Image.open only parses the header, check dimensions before any pixel data is decoded
         image = Image.open(io.BytesIO(file_content))
-        image.verify()  # Verify image integrity
-        print("Image successfully verified.")
+        width, height = image.size
+        if image.format not in ('JPEG', 'PNG'):
+            raise ValueError(f"Unsupported image content: {image.format}")
+        if max(width, height) > MAX_IMAGE_DIMENSION or width * height > MAX_IMAGE_PIXELS:
+            raise ValueError(f"Image dimensions {width}x{height} exceed the allowed limits")
 
-        # Step 4: Double-check if Pillow can read the image fully
-        image = Image.open(io.BytesIO(file_content))  # Reopen to ensure no issues
-        image.load()  # Force loading the entire image to catch issues
-        return True
+        # Step 5: Structural integrity check, which does not decode the full image but needs all of its bytes
+        if total_size is None:
+            image.verify()
+        print(f"Image successfully verified: {image.format} {width}x{height}")
+
+        result.update(valid=True, format=image.format, width=width, height=height)
 
     except UnidentifiedImageError as e:
         print(f"UnidentifiedImageError: {str(e)} - The file content might be corrupted.")
+        result['error'] = "File is not a readable image"
     except ValueError as ve:
         print(f"Validation Error: {str(ve)}")
+        result['error'] = str(ve)
     except Exception as e:
         print(f"Unexpected error during image validation: {str(e)}")
-    return False
+        result['error'] = "Image could not be verified"
+    return result
+
+
+def validate_uploads(image_files):
+    """
+    Validates every uploaded image before any of them is stored.
+    :param image_files: (filename, file_content, content_type, s3_key, size) tuples. s3_key and size are set for
+                        presigned uploads, whose file_content only holds the image header.
+    :return: (filename, validation result, content_type, s3_key, size) tuples.
+    """
+    # Bounds the decodes of one request, for multipart uploads as well as presigned ones
+    if len(image_files) > MAX_UPLOAD_FILES:
+        raise BadRequestError(f"At most {MAX_UPLOAD_FILES} images can be uploaded at once")
+
+    validated = []
+    for filename, file_content, content_type, s3_key, size in image_files:
+        validation = validate_image(file_content, filename, total_size=size)
+        if not validation['valid']:
+            # The item is not created, so none of the presigned uploads sent with it will be referenced
+            delete_uploads([image_file[3] for image_file in image_files if image_file[3]])
+            raise BadRequestError(f"Invalid image {filename}: {validation['error']}")
+        validated.append((filename, validation, content_type, s3_key, size))
+    return validated
+
+
+def delete_uploads(s3_keys):
+    """Deletes presigned uploads that will not be used, leftovers expire through the bucket lifecycle rule."""
+    if not s3_keys:
+        return
+    try:
+        get_client('s3').delete_objects(
+            Bucket=os.environ['S3_BUCKET_NAME'],
+            Delete={'Objects': [{'Key': s3_key} for s3_key in s3_keys], 'Quiet': True}
+        )
+    except Exception as e:
+        print(f"Failed to delete unused uploads {s3_keys}: {e}")
+
+
+def fetch_uploaded_image(s3_key):
+    """
+    Fetches the header of an image the client uploaded through a presigned POST, the rest stays in S3.
+    :param s3_key: Key returned by /item/upload-urls.
+    :return: (filename, header bytes, content_type, s3_key, size) tuple in the same shape as multipart uploads.
+    """
+    match = UPLOAD_KEY_PATTERN.match(s3_key or '')
+    if not match:
+        raise BadRequestError(f"Invalid image key: {s3_key}")
+
+    try:
+        s3_object = get_client('s3').get_object(
+            Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_key, Range=f"bytes=0-{UPLOAD_HEADER_BYTES - 1}"
+        )
+    except get_client('s3').exceptions.NoSuchKey:
+        raise BadRequestError(f"Image was not uploaded: {s3_key}")
+
+    # Content-Range is "bytes 0-262143/<total size>"
+    size = int(s3_object['ContentRange'].rsplit('/', 1)[1])
+    return match.group('filename'), s3_object['Body'].read(), s3_object.get('ContentType', 'image/jpeg'), s3_key, size
+
+
+def fetch_uploaded_images(s3_keys):
+    """Fetches the headers of presigned uploads concurrently, keeping the order of the keys."""
+    if not isinstance(s3_keys, list) or len(s3_keys) > MAX_UPLOAD_FILES:
+        raise BadRequestError(f"image_keys must be a list of at most {MAX_UPLOAD_FILES} keys")
+    try:
+        return map_concurrently(fetch_uploaded_image, s3_keys)
+    except BadRequestError:
+        delete_uploads([s3_key for s3_key in s3_keys if UPLOAD_KEY_PATTERN.match(str(s3_key))])
+        raise
+
+
+def promote_upload(upload_key, s3_key):
+    """
+    Moves a validated presigned upload out of UPLOAD_PREFIX with a server-side copy, so the lifecycle rule on
+    that prefix only ever expires abandoned uploads.
+    :return: Public URL of the image at its final key.
+    """
+    s3 = get_client('s3')
+    bucket = os.environ['S3_BUCKET_NAME']
+    s3.copy_object(Bucket=bucket, Key=s3_key, CopySource={'Bucket': bucket, 'Key': upload_key})
+    s3.delete_object(Bucket=bucket, Key=upload_key)
+    return object_url(s3_key)
 
 
 def is_base64_encoded(data):
     """ Check if the image is base64 encoded. """
-    try:
-        # Detect common base64 headers (e.g., data:image/jpeg;base64)
-        base64_header_pattern = re.compile(r'^data:image\/[a-zA-Z]+;base64,')
-        if base64_header_pattern.match(data.decode('utf-8', errors='ignore')):
-            return True
-    except Exception:
-        return False
-    return False
+    # Only the start of the payload can hold the header (e.g., data:image/jpeg;base64,)
+    return BASE64_HEADER_PATTERN.match(data[:64]) is not None
 
 
 def decode_base64_image(data):
     """ Decode base64-encoded image to binary format. """
     try:
         # Remove header and decode base64 content
-        header, encoded = re.split(',', data.decode('utf-8'), 1)
+        header, encoded = data.split(b',', 1)
         return base64.b64decode(encoded)
     except Exception as e:
         print(f"Failed to decode base64 image: {str(e)}")
         return data  # Return original data as fallback
 
-def call_amazon_rekognition(bucket_name, object_key):
+def process_image(image_file):
     """
-    Call Amazon Rekognition to detect labels for the given image in an S3 bucket.
-    :param bucket_name: S3 bucket where the image is stored.
-    :param object_key: S3 key for the image.
-    :return: List of labels or an empty list on failure.
+    Stores and labels one validated image. Runs on a worker thread in create_item.
+    :param image_file: (filename, validation result, content_type, s3_key, size) tuple from validate_uploads.
+    :return: (image_url, derivative_urls, labels) tuple, labels is None when labeling is left to the SQS worker.
     """
-    try:
-        # Print basic information for debugging
-        print(f"Attempting to detect labels for image in bucket: {bucket_name}, key: {object_key}")
+    filename, validation, content_type, uploaded_key, size = image_file
+    s3_key = f"items/{uuid.uuid4()}_{filename}"
 
-        rekognition_client = boto3.client('rekognition', region_name=os.environ['REGION'])
+    if uploaded_key:
+        # Presigned uploads stay in S3: Rekognition reads the object itself and the SQS worker
+        # generates the derivatives, so the image never passes through this request
+        image_url = promote_upload(uploaded_key, s3_key)
+        if ASYNC_LABELING or size > REKOGNITION_MAX_S3_BYTES:
+            return image_url, dict.fromkeys(DERIVATIVE_SIZES), None
+        return image_url, dict.fromkeys(DERIVATIVE_SIZES), call_amazon_rekognition(filename, s3_key=s3_key)
 
-        # Fetching metadata of the S3 object for validation
-        s3 = boto3.client('s3')
-        metadata = s3.head_object(Bucket=bucket_name, Key=object_key)
-        print(f"S3 Object Metadata: {metadata}")
+    file_content = validation['content']
 
-        # Ensuring that the file is in a valid format
-        if not object_key.lower().endswith(('.jpg', '.jpeg', '.png')):
-            print("Error: The file is not a valid image format. Only JPEG and PNG are supported.")
-            return []
+    # Decode once, the same image feeds the derivatives and the Rekognition downscale
+    image = decode_upload(file_content)
 
-        response = rekognition_client.detect_labels(
-            Image={'S3Object': {'Bucket': bucket_name, 'Name': object_key}},
-            MaxLabels=10,
-            MinConfidence=70
-        )
+    # Upload image to S3 with the Content-Type from the multipart headers
+    image_url, derivative_urls = store_image(s3_key, file_content, content_type, image)
 
-        # Extract label names
-        labels = [label['Name'] for label in response['Labels']]
-        print(f"Extracted labels: {labels}")
+    if ASYNC_LABELING:
+        # Labels are filled in later by the SQS worker
+        return image_url, derivative_urls, None
 
-        return labels
-
-    except Exception as e:
-        print("Error occurred while calling Amazon Rekognition:")
-        print(f"Exception: {str(e)}")
-        traceback.print_exc()
-        return []
+    # Call Rekognition on the bytes we already hold rather than having it read the object back from S3
+    labels = call_amazon_rekognition(filename, file_content=prepare_rekognition_bytes(file_content, image))
+    return image_url, derivative_urls, labels
 
 @item_routes.route('/category', methods=['GET'], cors=True)
 def get_category():
-    # SQL query to get all items
-    sql = """
-        SELECT *
-        FROM category
+    categories = get_categories()
+
+    if is_not_modified(item_routes.current_request.headers, categories["etag"]):
+        return Response(body='', status_code=304, headers={'ETag': categories["etag"]})
+
+    return Response(
+        body=categories["body"],
+        status_code=200,
+        headers={
+            'Content-Type': 'application/json',
+            'ETag': categories["etag"],
+            'Cache-Control': 'no-cache'
+        }
+    )
+
+@item_routes.route('/items', methods=['GET'], cors=True)
+def get_items():
+    params = item_routes.current_request.query_params or {}
+
+    try:
+        limit = min(int(params.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+
+        order = params.get('order', 'desc').lower()
+        if order not in ('asc', 'desc'):
+            raise ValueError("order must be 'asc' or 'desc'")
+
+        # List cards only need a few columns, fields=full or a column list asks for more
+        fields = parse_fields(params.get('fields'), 'summary')
+
+        conditions = []
+        args = []
+
+        # Equality filters, each backed by a (column, found_at, id) index
+        for column in ('status', 'category', 'brand'):
+            if params.get(column):
+                conditions.append(f"{column} = %s")
+                args.append(params[column])
+
+        if params.get('found_from'):
+            conditions.append("found_at >= %s")
+            args.append(parse_datetime_param(params['found_from']))
+        if params.get('found_to'):
+            conditions.append("found_at <= %s")
+            args.append(parse_datetime_param(params['found_to'], end_of_day=True))
+
+        # Keyset condition: continue strictly after the last (found_at, id) of the previous page
+        if params.get('cursor'):
+            cursor = decode_cursor(params['cursor'])
+            if not (isinstance(cursor, list) and len(cursor) == 2 and isinstance(cursor[0], str)
+                    and type(cursor[1]) is int):
+                raise ValueError("Invalid cursor")
+            last_found_at, last_id = cursor
+            op = '<' if order == 'desc' else '>'
+            conditions.append(f"(found_at {op} %s OR (found_at = %s AND id {op} %s))")
+            args.extend([last_found_at, last_found_at, int(last_id)])
+    except (ValueError, TypeError) as e:
+        raise BadRequestError(str(e))
+
+    # found_at and updated_at back the cursor and Last-Modified even when they are not requested
+    columns = list(fields) + [column for column in ('found_at', 'updated_at') if column not in fields]
+    sql = f"""
+        SELECT {", ".join(columns)}
+        FROM items
+        {"WHERE " + " AND ".join(conditions) if conditions else ""}
+        ORDER BY found_at {order.upper()}, id {order.upper()}
+        LIMIT %s
     """
+    # Fetch one extra row to know whether another page exists
+    args.append(limit + 1)
 
-    with create_connection().cursor() as cursor:
-        cursor.execute(sql)
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(sql, args)
         result = cursor.fetchall()
 
-        # Use json_serial to serialize date, time, and timedelta fields
-        serialized_result = json.loads(json.dumps(result, default=json_serial))
+        next_cursor = None
+        if len(result) > limit:
+            result = result[:limit]
+            next_cursor = encode_cursor([result[-1]['found_at'], result[-1]['id']])
+
+    headers = {'Cache-Control': 'no-cache'}
+    updated = [row['updated_at'] for row in result if row.get('updated_at')]
+    if updated:
+        headers['Last-Modified'] = http_date(max(updated))
+
+    if len(columns) > len(fields):
+        result = [{column: row[column] for column in fields} for row in result]
+
+    # Serialize date, time, and timedelta fields once, straight into the response body. The ETag covers the
+    # whole page, so items that changed, appeared or were deleted all produce a new one
+    body = encode_json({
+        "items": encode_rows(result, ITEM_JSON_COLUMNS),
+        "next_cursor": next_cursor
+    })
+    headers['ETag'] = make_etag(body)
+
+    # Only the ETag is checked, a deleted item leaves no newer updated_at behind
+    if is_not_modified(item_routes.current_request.headers, headers['ETag']):
+        return Response(body='', status_code=304, headers=headers)
+
+    return Response(body=body, status_code=200, headers={'Content-Type': 'application/json', **headers})
+
+@item_routes.route('/items/search', methods=['GET'], cors=True)
+def search_items():
+    params = item_routes.current_request.query_params or {}
+    query = (params.get('q') or '').strip()
+    if not query:
+        raise BadRequestError("Missing required parameter q")
+    if len(query) > MAX_SEARCH_QUERY_LENGTH:
+        raise BadRequestError(f"q cannot be longer than {MAX_SEARCH_QUERY_LENGTH} characters")
 
-        return {
-            "category": serialized_result
-        }
-
-@item_routes.route('/items', methods=['GET'], cors=True)
-def get_items():
-    # SQL query to get all items
-    sql = """
-        SELECT *
+    try:
+        limit = min(int(params.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        # Relevance scores are not a stable sort key, so the cursor carries a plain offset
+        offset = 0
+        if params.get('cursor'):
+            cursor = decode_cursor(params['cursor'])
+            if not (isinstance(cursor, list) and len(cursor) == 1 and type(cursor[0]) is int and cursor[0] >= 0):
+                raise ValueError("Invalid cursor")
+            offset = cursor[0]
+        fields = parse_fields(params.get('fields'), 'full')
+    except (ValueError, TypeError, IndexError) as e:
+        raise BadRequestError(str(e))
+
+    conditions = [f"MATCH({SEARCH_COLUMNS}) AGAINST (%s IN NATURAL LANGUAGE MODE)"]
+    args = [query, query]
+    if params.get('status'):
+        conditions.append("status = %s")
+        args.append(params['status'])
+
+    sql = f"""
+        SELECT {", ".join(fields)}, MATCH({SEARCH_COLUMNS}) AGAINST (%s IN NATURAL LANGUAGE MODE) AS relevance
         FROM items
+        WHERE {" AND ".join(conditions)}
+        ORDER BY relevance DESC, id DESC
+        LIMIT %s OFFSET %s
     """
+    # Fetch one extra row to know whether another page exists
+    args.extend([limit + 1, offset])
 
-    with create_connection().cursor() as cursor:
-        cursor.execute(sql)
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(sql, args)
         result = cursor.fetchall()
 
-        # Use json_serial to serialize date, time, and timedelta fields
-        serialized_result = json.loads(json.dumps(result, default=json_serial))
+        next_cursor = None
+        if len(result) > limit:
+            result = result[:limit]
+            next_cursor = encode_cursor([offset + limit])
 
-        return {
-            "items": serialized_result
-        }
+        # Serialize date, time, and timedelta fields once, straight into the response body
+        return json_response({
+            "items": encode_rows(result, ITEM_JSON_COLUMNS),
+            "next_cursor": next_cursor
+        })
+
+@item_routes.route('/item/upload-urls', cors=True, methods=['POST'])
+def create_upload_urls():
+    """
+    Issues presigned POSTs so browsers upload images straight to S3. The returned keys are then
+    sent as image_keys in a JSON body to /item/create or /item/update/{id}.
+    """
+    body = item_routes.current_request.json_body or {}
+    files = body.get('files')
+    if not isinstance(files, list) or not files or len(files) > MAX_UPLOAD_FILES:
+        raise BadRequestError(f"files must be a list of 1 to {MAX_UPLOAD_FILES} entries")
+
+    s3 = get_client('s3')
+    uploads = []
+    for file in files:
+        filename = re.sub(r'[^A-Za-z0-9._-]', '_', os.path.basename(str(file.get('filename', ''))))
+        extension = filename.split('.')[-1].lower()
+        if extension not in UPLOAD_CONTENT_TYPES:
+            raise BadRequestError(f"Unsupported image format: {extension}")
+
+        content_type = UPLOAD_CONTENT_TYPES[extension]
+        s3_key = f"{UPLOAD_PREFIX}{uuid.uuid4()}_{filename}"
+        presigned_post = s3.generate_presigned_post(
+            Bucket=os.environ['S3_BUCKET_NAME'],
+            Key=s3_key,
+            Fields={'Content-Type': content_type},
+            Conditions=[
+                {'Content-Type': content_type},
+                ['content-length-range', 1, MAX_UPLOAD_BYTES]
+            ],
+            ExpiresIn=UPLOAD_URL_EXPIRY
+        )
+        uploads.append({'key': s3_key, 'url': presigned_post['url'], 'fields': presigned_post['fields']})
 
-@item_routes.route('/item/create', cors=True, methods=['POST'], content_types=['multipart/form-data'])
+    return {"uploads": uploads}
+
+@item_routes.route('/item/create', cors=True, methods=['POST'], content_types=['multipart/form-data', 'application/json'])
 def create_item():
     try:
         print("Starting item creation process...")
 
-        # Decode the multipart/form-data using requests-toolbelt
-        print("Decoding multipart/form-data")
         request = item_routes.current_request
-        content_type = request.headers['content-type']
-        multipart_data = decoder.MultipartDecoder(request.raw_body, content_type)
-
-        # Initialize form data and files
-        form_data = {}
-        image_files = []
-
-        # Parse multipart form data
-        for part in multipart_data.parts:
-            content_disposition = part.headers.get(b'Content-Disposition', b'').decode('utf-8')
-            print(f"Processing part: {content_disposition}")
-
-            if 'filename=' in content_disposition:
-                filename = content_disposition.split('filename=')[1].strip('"')
-                content_type = part.headers[b'Content-Type'].decode('utf-8')
-                print(f"Found file: {filename} with Content-Type: {content_type}")
-                print(f"Size of uploaded image: {len(part.content)} bytes")
-                file_content = io.BytesIO(part.content).getvalue()
-                image_files.append((filename, file_content, content_type))
-            else:
-                name = content_disposition.split('name=')[1].strip('"')
-                form_data[name] = part.text
-                print(f"Found form field: {name} = {form_data[name]}")
+        if request.headers['content-type'].startswith('application/json'):
+            # Finalize a presigned upload: the images are already in S3, only their keys are sent
+            form_data = request.json_body or {}
+            image_files = fetch_uploaded_images(form_data.get('image_keys', []))
+        else:
+            # Decode the multipart/form-data using requests-toolbelt
+            from requests_toolbelt.multipart.decoder import MultipartDecoder
+            print("Decoding multipart/form-data")
+            content_type = request.headers['content-type']
+            multipart_data = MultipartDecoder(request.raw_body, content_type)
+
+            # Initialize form data and files
+            form_data = {}
+            image_files = []
+
+            # Parse multipart form data
+            for part in multipart_data.parts:
+                content_disposition = part.headers.get(b'Content-Disposition', b'').decode('utf-8')
+                print(f"Processing part: {content_disposition}")
+
+                if 'filename=' in content_disposition:
+                    filename = content_disposition.split('filename=')[1].strip('"')
+                    content_type = part.headers[b'Content-Type'].decode('utf-8')
+                    print(f"Found file: {filename} with Content-Type: {content_type}")
+                    print(f"Size of uploaded image: {len(part.content)} bytes")
+                    file_content = io.BytesIO(part.content).getvalue()
+                    image_files.append((filename, file_content, content_type, None, None))
+                else:
+                    name = content_disposition.split('name=')[1].strip('"')
+                    form_data[name] = part.text
+                    print(f"Found form field: {name} = {form_data[name]}")
 
         # Extract form data fields and handle defaults
         item_name = form_data.get('item_name', 'Unknown Item')
@@ -206,64 +498,43 @@ def create_item():
 
         # Initialize arrays for image URLs and labels
         image_urls = []
+        thumbnail_urls = []
+        medium_urls = []
         all_labels = []
-        category_names = []
+        detected_labels = []
 
-        # Fetch available categories from the database
-        with create_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("SELECT name FROM category")
-                categories_in_db = [row['name'] for row in cursor.fetchall()]
-        print(f"Available categories: {categories_in_db}")
-
-        # Process uploaded image files
-        s3 = boto3.client('s3')
-        for filename, file_content, content_type in image_files:
-            validate_image(file_content, filename)
-            s3_bucket = os.environ['S3_BUCKET_NAME']
-            s3_key = f"items/{uuid.uuid4()}_{filename}"
-            print(f"Uploading file to S3: Bucket = {s3_bucket}, Key = {s3_key}")
-
-            # Upload image to S3 with the detected content type
-            s3.put_object(
-                Bucket=s3_bucket,
-                Key=s3_key,
-                Body=file_content,
-                ContentType=content_type  # Directly use the Content-Type from the multipart headers
-            )
+        # Upload and label every image concurrently, results keep the order of the submitted files
+        processed_images = map_concurrently(process_image, validate_uploads(image_files))
 
-            # Generate image URL
-            image_url = f"https://{s3_bucket}.s3.amazonaws.com/{urllib.quote(s3_key)}"
+        for (filename, *_), (image_url, derivative_urls, labels) in zip(image_files, processed_images):
             image_urls.append(image_url)
-            print(f"Uploaded image URL: {image_url}")
-
-            # Call Rekognition to get labels
-            labels = call_amazon_rekognition(s3_bucket, s3_key)
+            thumbnail_urls.append(derivative_urls['thumbnail'])
+            medium_urls.append(derivative_urls['medium'])
             print(f"Rekognition labels for {filename}: {labels}")
-            all_labels.append(labels)
-
-            # Match labels to categories
-            for label in labels:
-                category_match = next((cat for cat in categories_in_db if cat.lower() in label.lower()), None)
-                if category_match:
-                    category_names.append(category_match)
-                else:
-                    category_names.append("Others")
+            detected_labels.append(labels or [])
+            all_labels.append(label_names(labels or []))
 
-        final_category = category_names[0] if category_names else "Others"
-        print(f"Final category selected: {final_category}")
+        if any(labels is None for *_, labels in processed_images):
+            # Placeholder until the worker has labeled the images
+            final_category = "Others"
+            labels_status = LABELS_PENDING
+        else:
+            final_category = choose_category(detected_labels)
+            labels_status = LABELS_DONE
 
         # Insert item details into the database
         sql_insert = """
-            INSERT INTO items (item_name, description, location, found_at, image_url, category, brand, status, labels)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, 'unclaimed', %s)
+            INSERT INTO items (item_name, description, location, found_at, image_url, thumbnail_url, medium_url,
+                               category, brand, status, labels, labels_status, labeled_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 'unclaimed', %s, %s, %s)
         """
-        with create_connection() as conn:
+        with get_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(sql_insert, (
                     item_name, description, location, found_at,
-                    json.dumps(image_urls), final_category, brand,
-                    json.dumps(all_labels)
+                    json.dumps(image_urls), json.dumps(thumbnail_urls), json.dumps(medium_urls),
+                    final_category, brand, json.dumps(all_labels), labels_status,
+                    datetime.utcnow() if labels_status == LABELS_DONE else None
                 ))
 
                 # Fetch the last inserted item
@@ -272,20 +543,26 @@ def create_item():
                 conn.commit()
                 print(f"Inserted item: {inserted_item}")
 
-        # Trigger notification
-        create_notification(inserted_item['id'])
-        print("Notification triggered for item creation.")
+        if labels_status == LABELS_PENDING:
+            # The worker generates any missing derivatives and notifies subscribers once the real category is known
+            create_label_job(inserted_item['id'])
+            print("Label enrichment queued for item creation.")
+        else:
+            # Trigger notification
+            create_notification(inserted_item['id'])
+            print("Notification triggered for item creation.")
+            if any(image_file[3] for image_file in image_files):
+                create_derivative_job(inserted_item['id'])
 
         # Return success response with item details
-        return Response(
-            body=json.dumps({'message': 'Item created successfully', 'item': inserted_item}, default=json_serial),
+        return json_response(
+            {'message': 'Item created successfully', 'item': encode_row(inserted_item, ITEM_JSON_COLUMNS)},
             status_code=201,
-            headers={
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            }
+            headers={'Access-Control-Allow-Origin': '*'}
         )
 
+    except BadRequestError:
+        raise
     except Exception as e:
         print("Error during item creation:", e)
         traceback.print_exc()
@@ -294,64 +571,64 @@ def create_item():
 @item_routes.route('/item/{id}', cors=True, methods=['GET'])
 def get_item(id):
     try:
-        print("this is working")
-        # SQL query to get a specific item by id
-        sql = """
-            SELECT *
-            FROM items
-            WHERE id = %s
-        """
+        # Served from the per-container item cache, which reads through to the database
+        entry = get_item_entry(int(id)) if id.isdigit() else None
+
+        if entry is None:
+            return Response(
+                body=json.dumps({'message': 'Item not found'}),
+                status_code=404,
+                headers={'Content-Type': 'application/json'}
+            )
 
-        with create_connection().cursor() as cursor:
-            cursor.execute(sql, (id,))
-            result = cursor.fetchone()
+        headers = {'ETag': entry["etag"], 'Cache-Control': 'no-cache'}
+        if entry["last_modified"]:
+            headers['Last-Modified'] = entry["last_modified"]
 
-            if result is None:
-                return Response(
-                    body=json.dumps({'message': 'Item not found'}),
-                    status_code=404,
-                    headers={'Content-Type': 'application/json'}
-                )
+        if is_not_modified(item_routes.current_request.headers, entry["etag"], entry["updated_at"]):
+            return Response(body='', status_code=304, headers=headers)
 
-            # Use json_serial to serialize date, time, and timedelta fields
-            serialized_result = json.loads(json.dumps(result, default=json_serial))
-
-            return {
-                "item": serialized_result
-            }
+        return Response(body=entry["body"], status_code=200, headers={'Content-Type': 'application/json', **headers})
 
     except Exception as e:
         print("Error during item retrieval:", e)
         traceback.print_exc()
         raise BadRequestError("Failed to retrieve item. Please try again.")
 
-@item_routes.route('/item/update/{id}', cors=True, methods=['PUT'], content_types=['multipart/form-data'])
+@item_routes.route('/item/update/{id}', cors=True, methods=['PUT'], content_types=['multipart/form-data', 'application/json'])
 def update_item(id):
     try:
-        # Decode the multipart/form-data using requests-toolbelt
         request = item_routes.current_request
-        content_type = request.headers['content-type']
-        multipart_data = decoder.MultipartDecoder(request.raw_body, content_type)
-
-        # Initialize form data and files
-        form_data = {}
-        new_image_files = []
-
-        # Parse each part of the multipart form-data
-        for part in multipart_data.parts:
-            content_disposition = part.headers.get(b'Content-Disposition', b'').decode()
-            if 'filename=' in content_disposition:  # Handle file uploads
-                filename = content_disposition.split('filename=')[1].strip('"')
-                new_image_files.append((filename, part.content))
-            else:  # Handle form fields
-                name = content_disposition.split('name=')[1].strip('"')
-                # For array fields like `image_url[]`, aggregate them properly
-                if name == 'image_url[]':
-                    if name not in form_data:
-                        form_data[name] = []
-                    form_data[name].append(part.text.strip())
-                else:
-                    form_data[name] = part.text.strip()
+        if request.headers['content-type'].startswith('application/json'):
+            # Finalize a presigned upload: new images are already in S3, only their keys are sent
+            form_data = dict(request.json_body or {})
+            form_data['image_url[]'] = form_data.get('image_url', [])
+            new_image_files = fetch_uploaded_images(form_data.get('image_keys', []))
+        else:
+            # Decode the multipart/form-data using requests-toolbelt
+            from requests_toolbelt.multipart.decoder import MultipartDecoder
+            content_type = request.headers['content-type']
+            multipart_data = MultipartDecoder(request.raw_body, content_type)
+
+            # Initialize form data and files
+            form_data = {}
+            new_image_files = []
+
+            # Parse each part of the multipart form-data
+            for part in multipart_data.parts:
+                content_disposition = part.headers.get(b'Content-Disposition', b'').decode()
+                if 'filename=' in content_disposition:  # Handle file uploads
+                    filename = content_disposition.split('filename=')[1].strip('"')
+                    new_image_files.append((filename, part.content, 'image/jpeg', None, None))
+                else:  # Handle form fields
+                    name = content_disposition.split('name=')[1].strip('"')
+                    # For array fields like `image_url[]`, aggregate them properly
+                    if name == 'image_url[]':
+                        if name not in form_data:
+                            form_data[name] = []
+                        form_data[name].append(part.text.strip())
+                    else:
+                        form_data[name] = part.text.strip()
 
         # Extract form fields
         item_name = form_data.get('item_name', '')
@@ -362,43 +639,53 @@ def update_item(id):
         brand = form_data.get('brand', 'Others')
         existing_image_urls = form_data.get('image_url[]', [])
 
-        # Process uploaded images and store them in S3
-        s3_bucket = os.environ['S3_BUCKET_NAME']
-        new_image_urls = []
-        for filename, file_content in new_image_files:
-
+        # Process uploaded images and store them in S3 together with their derivatives, concurrently.
+        # Presigned uploads are only moved into place, the SQS worker generates their derivatives
+        def store_new_image(image_file):
+            filename, validation, content_type, uploaded_key, _ = image_file
             s3_key = f"items/{category}/{uuid.uuid4()}_{filename}"
+            if uploaded_key:
+                return promote_upload(uploaded_key, s3_key), dict.fromkeys(DERIVATIVE_SIZES)
+            return store_image(s3_key, validation['content'], content_type, decode_upload(validation['content']))
 
-            # Upload the image to S3
-            s3.put_object(
-                Bucket=s3_bucket,
-                Key=s3_key,
-                Body=file_content,
-                ContentType='image/jpeg'
-            )
-
-            # Generate S3 URL
-            image_url = f"https://{s3_bucket}.s3.amazonaws.com/{urllib.quote(s3_key)}"
-            new_image_urls.append(image_url)
-
-        # Combine existing and new image URLs
-        final_image_urls = existing_image_urls + new_image_urls
-
-        # SQL query to update the item details in the database
-        sql_update = """
-            UPDATE items
-            SET item_name = %s, description = %s, location = %s, found_at = %s, image_url = %s, category = %s, brand = %s
-            WHERE id = %s
-        """
+        new_images = map_concurrently(store_new_image, validate_uploads(new_image_files))
 
-        # Connect to the database and execute the update query
-        with create_connection() as conn:
+        with get_connection() as conn:
             with conn.cursor() as cursor:
+                # Carry over the derivatives of the images that are kept
+                cursor.execute("SELECT image_url, thumbnail_url, medium_url FROM items WHERE id = %s", (id,))
+                current = cursor.fetchone() or {}
+                current_urls = json.loads(current.get('image_url') or '[]')
+                current_derivatives = {
+                    size_name: dict(zip(current_urls, json.loads(current.get(f"{size_name}_url") or '[]')))
+                    for size_name in DERIVATIVE_SIZES
+                }
+
+                # Combine existing and new image URLs
+                final_image_urls = existing_image_urls + [image_url for image_url, _ in new_images]
+                final_derivative_urls = {
+                    size_name: [current_derivatives[size_name].get(url) for url in existing_image_urls]
+                               + [derivative_urls[size_name] for _, derivative_urls in new_images]
+                    for size_name in DERIVATIVE_SIZES
+                }
+
+                # SQL query to update the item details in the database
+                sql_update = """
+                    UPDATE items
+                    SET item_name = %s, description = %s, location = %s, found_at = %s, image_url = %s,
+                        thumbnail_url = %s, medium_url = %s, category = %s, brand = %s
+                    WHERE id = %s
+                """
                 cursor.execute(sql_update, (
-                    item_name, description, location, found_at,
-                    json.dumps(final_image_urls), category, brand, id
+                    item_name, description, location, found_at, json.dumps(final_image_urls),
+                    json.dumps(final_derivative_urls['thumbnail']), json.dumps(final_derivative_urls['medium']),
+                    category, brand, id
                 ))
             conn.commit()
+        invalidate_items([id])
+
+        if any(image_file[3] for image_file in new_image_files):
+            create_derivative_job(id)
 
         # Return success response
         return Response(
@@ -410,6 +697,8 @@ def update_item(id):
             }
         )
 
+    except BadRequestError:
+        raise
     except Exception as e:
         print("Error during item update:", e)
         traceback.print_exc()
@@ -424,10 +713,11 @@ def delete_item(id):
             WHERE id = %s
         """
 
-        with create_connection() as conn:
+        with get_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(sql, (id,))
                 conn.commit()
+        invalidate_items([id])
 
         return Response(
             body=json.dumps({'message': 'Item deleted successfully'}),
@@ -450,10 +740,11 @@ def claim_item(id):
             WHERE id = %s AND status = 'unclaimed'
         """
 
-        with create_connection() as conn:
+        with get_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(sql, (id,))
                 conn.commit()
+        invalidate_items([id])
 
         return Response(
             body=json.dumps({'message': 'Item status updated to claimed successfully'}),
@@ -476,10 +767,11 @@ def unclaim_item(id):
             WHERE id = %s AND status = 'claimed'
         """
 
-        with create_connection() as conn:
+        with get_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(sql, (id,))
                 conn.commit()
+        invalidate_items([id])
 
         return Response(
             body=json.dumps({'message': 'Item status updated to unclaimed successfully'}),
@@ -490,4 +782,151 @@ def unclaim_item(id):
     except Exception as e:
         print("Error during item status update:", e)
         traceback.print_exc()
-        raise BadRequestError("Failed to unclaim item. Please try again.")
\ No newline at end of file
+        raise BadRequestError("Failed to unclaim item. Please try again.")
+
+
+def stored_category(labels_json, matcher):
+    """Category chosen from the labels stored on an item, see labeling.choose_category."""
+    all_labels = json.loads(labels_json or '[]')
+    # Older rows may hold one flat list of names instead of one list per image
+    if any(isinstance(labels, str) for labels in all_labels):
+        all_labels = [all_labels]
+    ranked = rank_categories(all_labels, matcher)
+    return ranked[0][0] if ranked and ranked[0][1] >= MIN_CATEGORY_SCORE else "Others"
+
+
+def delete_item_images(rows):
+    """Deletes the originals and derivatives of deleted items from S3, failures are logged and left behind."""
+    keys = [
+        object_key(url)
+        for row in rows
+        for column in ('image_url', 'thumbnail_url', 'medium_url')
+        for url in json.loads(row.get(column) or '[]') if url
+    ]
+    batches = [keys[start:start + S3_DELETE_BATCH_SIZE] for start in range(0, len(keys), S3_DELETE_BATCH_SIZE)]
+
+    def delete_batch(batch):
+        try:
+            response = get_client('s3').delete_objects(
+                Bucket=os.environ['S3_BUCKET_NAME'],
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+            )
+            return [error['Key'] for error in response.get('Errors', [])]
+        except Exception as e:
+            print(f"Failed to delete {len(batch)} images: {e}")
+            return batch
+
+    failed = [key for errors in map_concurrently(delete_batch, batches) for key in errors]
+    print(f"Deleted {len(keys) - len(failed)} of {len(keys)} item images, failed: {failed}")
+
+
+@item_routes.route('/items/bulk', authorizer=admin_authorizer, cors=True, methods=['POST'])
+def bulk_update_items():
+    """
+    Applies one action to many items in a single transaction.
+    Body: {"action": "claim" | "unclaim" | "delete" | "recategorize", "ids": [...], "category": optional}.
+    recategorize sets the given category, or re-ranks each item's stored labels when none is given.
+    Returns one result per id, items missing or not in the expected status are reported instead of changed.
+    """
+    body = item_routes.current_request.json_body or {}
+    action = body.get('action')
+    if action not in BULK_ACTIONS:
+        raise BadRequestError(f"action must be one of {', '.join(BULK_ACTIONS)}")
+
+    ids = body.get('ids')
+    try:
+        if not isinstance(ids, list):
+            raise ValueError
+        # Drop duplicates but keep the order
+        ids = list(dict.fromkeys(int(item_id) for item_id in ids))
+    except (TypeError, ValueError):
+        raise BadRequestError("ids must be a list of item ids")
+    if not ids or len(ids) > MAX_BULK_ITEMS:
+        raise BadRequestError(f"ids must hold 1 to {MAX_BULK_ITEMS} item ids")
+
+    category = body.get('category')
+    if category is not None:
+        if action != 'recategorize':
+            raise BadRequestError("category is only accepted by recategorize")
+        category_id = get_category_id(category)
+        if category_id is None:
+            raise BadRequestError(f"Unknown category: {category}")
+        category = get_category_name(category_id)
+
+    placeholders = ', '.join(['%s'] * len(ids))
+    results = {}
+    changed_rows = []
+
+    with get_connection() as conn, conn.cursor() as cursor:
+        conn.begin()
+        # Lock the rows so the statuses checked here are the ones the update sees
+        cursor.execute(f"""
+            SELECT id, status, category, labels, labels_status, image_url, thumbnail_url, medium_url
+            FROM items
+            WHERE id IN ({placeholders})
+            FOR UPDATE
+        """, ids)
+        rows = {row['id']: row for row in cursor.fetchall()}
+
+        for item_id in ids:
+            if item_id not in rows:
+                results[item_id] = {'id': item_id, 'result': 'not_found'}
+
+        if action in BULK_STATUS_ACTIONS:
+            expected, new_status = BULK_STATUS_ACTIONS[action]
+            for row in rows.values():
+                if row['status'] == expected:
+                    changed_rows.append(row)
+                    results[row['id']] = {'id': row['id'], 'result': new_status}
+                else:
+                    results[row['id']] = {'id': row['id'], 'result': 'skipped',
+                                          'message': f"Item is {row['status']}, expected {expected}"}
+            if changed_rows:
+                changed_ids = [row['id'] for row in changed_rows]
+                cursor.execute(
+                    f"UPDATE items SET status = %s WHERE status = %s AND id IN ({', '.join(['%s'] * len(changed_ids))})",
+                    [new_status, expected] + changed_ids
+                )
+
+        elif action == 'delete':
+            changed_rows = list(rows.values())
+            for row in changed_rows:
+                results[row['id']] = {'id': row['id'], 'result': 'deleted'}
+            if changed_rows:
+                cursor.execute(f"DELETE FROM items WHERE id IN ({placeholders})", ids)
+
+        else:
+            matcher = get_category_matcher()
+            new_categories = {}
+            for row in rows.values():
+                if category is None and row['labels_status'] == LABELS_PENDING:
+                    results[row['id']] = {'id': row['id'], 'result': 'skipped', 'message': "Labels are still pending"}
+                    continue
+                new_category = category or stored_category(row['labels'], matcher)
+                if new_category == row['category']:
+                    results[row['id']] = {'id': row['id'], 'result': 'unchanged', 'category': new_category}
+                else:
+                    new_categories[row['id']] = new_category
+                    changed_rows.append(row)
+                    results[row['id']] = {'id': row['id'], 'result': 'recategorized', 'category': new_category}
+            if new_categories:
+                cases = ' '.join(['WHEN %s THEN %s'] * len(new_categories))
+                cursor.execute(
+                    f"UPDATE items SET category = CASE id {cases} END "
+                    f"WHERE id IN ({', '.join(['%s'] * len(new_categories))})",
+                    [value for pair in new_categories.items() for value in pair] + list(new_categories)
+                )
+
+        conn.commit()
+
+    # Side effects run once for the whole batch, after the transaction is committed
+    invalidate_items([row['id'] for row in changed_rows])
+    if action == 'delete' and changed_rows:
+        delete_item_images(changed_rows)
+
+    print(f"Bulk {action}: {len(changed_rows)} of {len(ids)} items changed")
+    return json_response({
+        'action': action,
+        'results': [results[item_id] for item_id in ids],
+        'changed': len(changed_rows)
+    })
@@ -0,0 +1,239 @@
+import json
+import os
+import re
+import traceback
+from datetime import datetime
+from .categoryCache import get_categories
+from .connectHelper import get_connection
+from .helpers import map_concurrently
+from .images import object_key, prepare_rekognition_bytes
+from .lazyRegistry import get_client
+
+# Runs Rekognition from the SQS worker instead of inside create_item when enabled
+ASYNC_LABELING = os.environ.get('ASYNC_LABELING', 'false').lower() == 'true'
+
+# labels_status values
+LABELS_PENDING = 'pending'
+LABELS_DONE = 'done'
+
+# Extra phrases that map Rekognition labels onto categories, keyed by lowercase category name.
+# Phrases only match whole words, so compounds such as "handbag" are listed explicitly.
+# Entries for categories missing from the category table are ignored.
+CATEGORY_ALIASES = {
+    'electronics': ['mobile phone', 'cell phone', 'phone', 'smartphone', 'laptop', 'computer', 'keyboard', 'tablet',
+                    'headphones', 'headset', 'earbuds', 'charger', 'power bank', 'cable', 'calculator', 'camera'],
+    'bags': ['bag', 'backpack', 'handbag', 'purse', 'luggage', 'suitcase', 'tote', 'tote bag'],
+    'wallets': ['wallet', 'purse', 'card holder'],
+    'clothing': ['apparel', 'clothing', 'jacket', 'coat', 'sweater', 'shirt', 'hoodie', 'hat', 'cap', 'scarf', 'shoe'],
+    'accessories': ['accessories', 'watch', 'jewelry', 'glasses', 'sunglasses', 'umbrella', 'belt'],
+    'bottles': ['bottle', 'water bottle', 'flask', 'tumbler'],
+    'keys': ['key', 'keychain'],
+    'stationery': ['pen', 'pencil', 'book', 'notebook', 'paper', 'stationery'],
+    'cards': ['id card', 'credit card', 'card', 'document'],
+}
+
+# Vote weights: direct category name match, alias match, and multiplier for a label's parent labels
+NAME_WEIGHT = 1.0
+ALIAS_WEIGHT = 0.8
+PARENT_FACTOR = 0.5
+
+# Minimum total score for a category to be chosen over "Others"
+MIN_CATEGORY_SCORE = 0.5
+
+# Largest object Rekognition reads through S3Object, bigger images are sent downscaled as Bytes instead
+REKOGNITION_MAX_S3_BYTES = 15 * 1024 * 1024
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+# (category etag, matcher) for the category table the matcher was built from
+_matcher_cache = None
+
+
+def call_amazon_rekognition(filename, file_content=None, s3_key=None):
+    """
+    Call Amazon Rekognition to detect labels for an image, either held in memory or already in S3.
+    :param filename: Original filename or key, used to check the format.
+    :param file_content: Image bytes, see images.prepare_rekognition_bytes.
+    :param s3_key: Key in the items bucket, used when no bytes are given.
+    :return: List of Rekognition label dicts (Name, Confidence, Parents) or an empty list on failure.
+    """
+    try:
+        print(f"Attempting to detect labels for image: {filename}")
+
+        # Ensuring that the file is in a valid format
+        if not filename.lower().endswith(('.jpg', '.jpeg', '.png')):
+            print("Error: The file is not a valid image format. Only JPEG and PNG are supported.")
+            return []
+
+        if file_content is not None:
+            image = {'Bytes': file_content}
+        else:
+            image = {'S3Object': {'Bucket': os.environ['S3_BUCKET_NAME'], 'Name': s3_key}}
+
+        response = get_client('rekognition').detect_labels(
+            Image=image,
+            MaxLabels=10,
+            MinConfidence=70
+        )
+
+        labels = response['Labels']
+        print(f"Extracted labels: {label_names(labels)}")
+
+        return labels
+
+    except Exception as e:
+        print("Error occurred while calling Amazon Rekognition:")
+        print(f"Exception: {str(e)}")
+        traceback.print_exc()
+        return []
+
+
+def label_names(labels):
+    """Label names as stored in items.labels."""
+    return [label['Name'] if isinstance(label, dict) else label for label in labels]
+
+
+def normalize(text):
+    """Lowercases text and reduces it to space-separated tokens, with simple plural folding."""
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    return ' '.join(token[:-1] if len(token) > 3 and token.endswith('s') and not token.endswith('ss') else token
+                    for token in tokens)
+
+
+def build_category_matcher(category_names):
+    """
+    Compiles the category table and CATEGORY_ALIASES into a single regex over normalized label text.
+    :param category_names: Names from the category table.
+    :return: Dict with the compiled pattern and the (category, weight) targets of every phrase.
+    """
+    targets = {}
+    for name in category_names:
+        if name == "Others":
+            continue
+        targets.setdefault(normalize(name), []).append((name, NAME_WEIGHT))
+        for alias in CATEGORY_ALIASES.get(name.lower(), []):
+            targets.setdefault(normalize(alias), []).append((name, ALIAS_WEIGHT))
+
+    phrases = [phrase for phrase in targets if phrase]
+    if not phrases:
+        return {'pattern': None, 'targets': targets}
+
+    # Longest phrases first so "water bottle" wins over "bottle". Normalized text is space-separated tokens, so
+    # word boundaries keep short aliases like "key" or "pen" out of "keyboard", "monkey" or "pendant"
+    alternation = '|'.join(re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True))
+    return {'pattern': re.compile(rf'\b(?:{alternation})\b'), 'targets': targets}
+
+
+def get_category_matcher():
+    """Returns the matcher for the current category table, rebuilt only when the table changes."""
+    global _matcher_cache
+    categories = get_categories()
+    if _matcher_cache is None or _matcher_cache[0] != categories["etag"]:
+        _matcher_cache = (categories["etag"], build_category_matcher(categories["names"]))
+    return _matcher_cache[1]
+
+
+def rank_categories(all_labels, matcher=None):
+    """
+    Scores categories by confidence-weighted votes from the labels of all images of an item.
+    :param all_labels: One list per image of Rekognition label dicts, or plain label names (full confidence).
+    :param matcher: Result of build_category_matcher, defaults to the one for the current category table.
+    :return: [(category, score)] sorted best first.
+
+    Short aliases only match whole words:
+
+    >>> matcher = build_category_matcher(['Electronics', 'Keys', 'Cards', 'Stationery', 'Clothing', 'Bags'])
+    >>> [rank_categories([[label]], matcher)[:1] for label in ['Monkey', 'Hockey', 'Cardigan', 'Pendant',
+    ...                                                         'Penguin', 'Open', 'Landscape', 'Chat']]
+    [[], [], [], [], [], [], [], []]
+    >>> label = {'Name': 'Computer Keyboard', 'Confidence': 90.0, 'Parents': [{'Name': 'Electronics'}]}
+    >>> [category for category, _ in rank_categories([[label]], matcher)]
+    ['Electronics']
+    >>> [rank_categories([[label]], matcher)[0][0] for label in ['Key', 'Pen', 'Cap', 'Handbag', 'Backpacks']]
+    ['Keys', 'Stationery', 'Clothing', 'Bags', 'Bags']
+    """
+    matcher = matcher or get_category_matcher()
+    if matcher['pattern'] is None:
+        return []
+
+    scores = {}
+    for labels in all_labels:
+        for label in labels:
+            if isinstance(label, dict):
+                name, confidence = label['Name'], label.get('Confidence', 100.0) / 100
+                parents = [parent['Name'] for parent in label.get('Parents', [])]
+            else:
+                name, confidence, parents = label, 1.0, []
+
+            # A label votes at most once per category, parents count for less than the label itself
+            votes = {}
+            for text, factor in [(name, 1.0)] + [(parent, PARENT_FACTOR) for parent in parents]:
+                for match in matcher['pattern'].finditer(normalize(text)):
+                    for category, weight in matcher['targets'][match.group(0)]:
+                        votes[category] = max(votes.get(category, 0.0), weight * factor)
+
+            for category, vote in votes.items():
+                scores[category] = scores.get(category, 0.0) + vote * confidence
+
+    return sorted(scores.items(), key=lambda entry: entry[1], reverse=True)
+
+
+def choose_category(all_labels):
+    """
+    Picks the item category from the labels of all its images.
+    :param all_labels: One list of labels per image, see rank_categories.
+    :return: Category name, "Others" when nothing scores high enough.
+    """
+    ranked = rank_categories(all_labels)
+    final_category = ranked[0][0] if ranked and ranked[0][1] >= MIN_CATEGORY_SCORE else "Others"
+    print(f"Category scores: {ranked[:3]}, final category selected: {final_category}")
+    return final_category
+
+
+def detect_object_labels(s3_key):
+    """
+    Labels an image stored in the items bucket, read by Rekognition directly unless it is too large for that.
+    :param s3_key: Key of the original image.
+    :return: List of Rekognition label dicts, see call_amazon_rekognition.
+    """
+    s3 = get_client('s3')
+    size = s3.head_object(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_key)['ContentLength']
+    if size <= REKOGNITION_MAX_S3_BYTES:
+        return call_amazon_rekognition(s3_key, s3_key=s3_key)
+
+    content = s3.get_object(Bucket=os.environ['S3_BUCKET_NAME'], Key=s3_key)['Body'].read()
+    return call_amazon_rekognition(s3_key, file_content=prepare_rekognition_bytes(content))
+
+
+def enrich_item_labels(item_id):
+    """
+    Labels the images of an item created with pending labels and sets its category.
+    :param item_id: Item to enrich.
+    :return: True if the item is labeled, including by an earlier delivery of the same job, False if it is missing.
+    """
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT image_url, labels_status FROM items WHERE id = %s", (item_id,))
+        item = cursor.fetchone()
+
+    if item is None:
+        print(f"Item {item_id} does not exist")
+        return False
+    if item['labels_status'] != LABELS_PENDING:
+        # A redelivered job whose labels were committed before the notification could be queued
+        print(f"Item {item_id} is already labeled")
+        return True
+
+    # The originals are already in S3, let Rekognition read them directly
+    s3_keys = [object_key(url) for url in json.loads(item['image_url'] or '[]')]
+    detected = map_concurrently(detect_object_labels, s3_keys)
+    category = choose_category(detected)
+    all_labels = [label_names(labels) for labels in detected]
+
+    with get_connection() as conn, conn.cursor() as cursor:
+        # Guard on the status so a redelivered message does not label the item twice
+        cursor.execute(
+            "UPDATE items SET labels = %s, category = %s, labels_status = %s, labeled_at = %s "
+            "WHERE id = %s AND labels_status = %s",
+            (json.dumps(all_labels), category, LABELS_DONE, datetime.utcnow(), item_id, LABELS_PENDING)
+        )
+    return True
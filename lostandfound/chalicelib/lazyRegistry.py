@@ -0,0 +1,52 @@
+import os
+import threading
+import time
+
+# Seconds before cached SSM values are fetched again, 0 keeps them for the container's lifetime
+SSM_CACHE_TTL = int(os.environ.get('SSM_CACHE_TTL', '0'))
+
+_clients = {}
+_ssm_cache = {}
+_lock = threading.Lock()
+
+
+def get_client(service_name):
+    """Returns a boto3 client for the service, created on first use and reused afterwards."""
+    client = _clients.get(service_name)
+    if client is not None:
+        return client
+
+    with _lock:
+        # Another thread may have created it while we were waiting
+        if service_name not in _clients:
+            start = time.perf_counter()
+            import boto3
+            _clients[service_name] = boto3.client(service_name)
+            print(f"Initialized boto3 client '{service_name}' in {(time.perf_counter() - start) * 1000:.1f} ms")
+        return _clients[service_name]
+
+
+def get_ssm_parameters(names, refresh=False):
+    """
+    Batch fetches decrypted SSM parameters and memoizes them.
+    :param names: Parameter names to fetch together.
+    :param refresh: Ignore the cached values and fetch again.
+    :return: Dict of parameter name to value.
+    """
+    key = tuple(names)
+    cached = _ssm_cache.get(key)
+    if cached and not refresh and not _expired(cached[0]):
+        return cached[1]
+
+    start = time.perf_counter()
+    response = get_client('ssm').get_parameters(Names=list(names), WithDecryption=True)
+    values = {param['Name']: param['Value'] for param in response['Parameters']}
+    print(f"Loaded {len(values)} SSM parameters in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    with _lock:
+        _ssm_cache[key] = (time.monotonic(), values)
+    return values
+
+
+def _expired(loaded_at):
+    return SSM_CACHE_TTL > 0 and time.monotonic() - loaded_at > SSM_CACHE_TTL
@@ -1,14 +1,31 @@
-from chalice import Blueprint, BadRequestError
+from chalice import Blueprint, BadRequestError, Cron, Rate
 import json
 import os
-from .connectHelper import create_connection
-from .helpers import json_serial
-import boto3
+from datetime import datetime, timedelta
+from .categoryCache import get_category_id
+from .connectHelper import get_connection
+from .emailSender import DIGEST_TEMPLATE, NEW_ITEMS_TEMPLATE, send_templated_bulk
+from .helpers import json_response
+from .images import fill_item_derivatives
+from .labeling import enrich_item_labels
+from .lazyRegistry import get_client
 
 notification_service = Blueprint(__name__)
-ses = boto3.client('ses')
-sqs = boto3.client('sqs')
-cognito_idp = boto3.client('cognito-idp')
+
+# How often a subscriber is emailed, and the look-back used for a digest subscriber's first digest
+NOTIFICATION_FREQUENCIES = {'instant': None, 'hourly': timedelta(hours=1), 'daily': timedelta(days=1)}
+
+# Messages per worker invocation, batches above 10 need a batching window of at least one second
+SQS_BATCH_SIZE = int(os.environ.get('SQS_BATCH_SIZE', '10'))
+SQS_BATCHING_WINDOW = max(int(os.environ.get('SQS_BATCHING_WINDOW', '0')), 1 if SQS_BATCH_SIZE > 10 else 0)
+
+# Sends of one notification, counting the first, before recipients it keeps failing for are given up on.
+# Each retry is delayed twice as long as the previous one, starting at RECIPIENT_RETRY_DELAY seconds
+MAX_RECIPIENT_ATTEMPTS = 3
+RECIPIENT_RETRY_DELAY = 60
+
+# Items listed in one digest, the newest are kept and the title still counts all of them
+MAX_DIGEST_ITEMS = 50
 
 
 def create_notification(itemId):
@@ -20,7 +37,53 @@ def create_notification(itemId):
     }
 
     # Send SQS message
-    response = sqs.send_message(
+    response = get_client('sqs').send_message(
+        QueueUrl=os.environ.get('SQS_URL'),
+        MessageBody=json.dumps(message)
+    )
+
+
+def create_label_job(itemId):
+    # Queue Rekognition labeling for an item created with pending labels
+    print(f"Queueing label enrichment for item {itemId}")
+    message = {
+        'type': 'labels',
+        'id': itemId
+    }
+
+    get_client('sqs').send_message(
+        QueueUrl=os.environ.get('SQS_URL'),
+        MessageBody=json.dumps(message)
+    )
+
+
+def create_recipient_retry(item_ids, emails, attempt):
+    # Queue a delayed resend of a notification to the recipients it failed for
+    print(f"Queueing attempt {attempt} of the notification for items {item_ids} to {len(emails)} recipients")
+    message = {
+        'type': 'recipients',
+        'ids': item_ids,
+        'emails': emails,
+        'attempt': attempt
+    }
+
+    get_client('sqs').send_message(
+        QueueUrl=os.environ.get('SQS_URL'),
+        MessageBody=json.dumps(message),
+        # SQS caps message delays at 15 minutes
+        DelaySeconds=min(RECIPIENT_RETRY_DELAY * 2 ** (attempt - 2), 900)
+    )
+
+
+def create_derivative_job(itemId):
+    # Queue derivative generation for an item whose images were uploaded straight to S3
+    print(f"Queueing derivative generation for item {itemId}")
+    message = {
+        'type': 'derivatives',
+        'id': itemId
+    }
+
+    get_client('sqs').send_message(
         QueueUrl=os.environ.get('SQS_URL'),
         MessageBody=json.dumps(message)
     )
@@ -33,11 +96,11 @@ def get_subscriptions():
 
         if email:
             sql = "SELECT * FROM notification_subscriptions WHERE email = %s"
-            with create_connection().cursor() as cursor:
+            with get_connection() as conn, conn.cursor() as cursor:
                 cursor.execute(sql, (email))
                 result = cursor.fetchall()
 
-                return json.loads(json.dumps(result, default=json_serial))
+                return json_response(result)
         else:
             raise BadRequestError("Missing required parameters email")
     else:
@@ -54,51 +117,64 @@ def create_subscription():
             body = notification_service.current_request.json_body
             print(body)
             categoryIds = body['categoryIds']
+            frequency = body.get('frequency', 'instant')
+            if frequency not in NOTIFICATION_FREQUENCIES:
+                raise BadRequestError(f"frequency must be one of {', '.join(NOTIFICATION_FREQUENCIES)}")
+
+            try:
+                requested = {int(categoryId) for categoryId in categoryIds}
+            except (TypeError, ValueError):
+                raise BadRequestError("categoryIds must be a list of category ids")
+
+            token = os.urandom(16).hex()
+
+            # One transaction, so a failure cannot leave the user with half their subscriptions
+            with get_connection() as conn, conn.cursor() as cursor:
+                conn.begin()
+                cursor.execute("SELECT categoryId FROM notification_subscriptions WHERE email = %s FOR UPDATE", (email,))
+                existing = {row['categoryId'] for row in cursor.fetchall()}
+
+                # Apply only the difference, each as a single statement
+                removed = existing - requested
+                if removed:
+                    cursor.execute(
+                        f"DELETE FROM notification_subscriptions WHERE email = %s AND categoryId IN ({', '.join(['%s'] * len(removed))})",
+                        [email, *removed]
+                    )
+                added = requested - existing
+                if added:
+                    cursor.execute(
+                        f"INSERT INTO notification_subscriptions (email, categoryId) VALUES {', '.join(['(%s, %s)'] * len(added))}",
+                        [value for categoryId in sorted(added) for value in (email, categoryId)]
+                    )
 
-            with create_connection().cursor() as cursor:
-                # Delete existing subscriptions
-                del_sql = "DELETE FROM notification_subscriptions WHERE email = %s"
-                cursor.execute(del_sql, (email))
-
-                # Insert new subscriptions
-                for categoryId in categoryIds:
-                    sql = "INSERT INTO notification_subscriptions (email, categoryId) VALUES (%s, %s)"
-                    cursor.execute(sql, (email, categoryId))
-
-            sql = "SELECT * FROM lostandfound.email_verifications WHERE email = %s"
-
-            with create_connection().cursor() as cursor:
-                cursor.execute(sql, (email))
-                result = cursor.fetchone()
-
-                with create_connection().cursor() as cursor:
-                    if result:
-                        sql = "DELETE FROM email_verifications WHERE email = %s"
-                        cursor.execute(sql, (email))
-
-                    recreate_sql = "INSERT INTO email_verifications (email, token) VALUES (%s, %s)"
-                    token = os.urandom(16).hex()
-                    cursor.execute(recreate_sql, (email, token))
-
-                    # Send email verification
-                    response = ses.send_email(
-                        Source=os.environ.get('SES_EMAIL'),
-                        Destination={
-                            'ToAddresses': [email]
-                        },
-                        Message={
-                            'Subject': {
-                                'Data': 'NYP Lost and Found Email Verification'
-                            },
-                            'Body': {
-                                'Text': {
-                                    'Data': 'Please verify your email by pasting the code below in the NYP Lost and Found website: \n\n' + token
-                                }
-                            }
+                # Issue a new verification token, resetting the verification state as before
+                cursor.execute('''
+                    INSERT INTO email_verifications (email, token, frequency) VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE token = VALUES(token), frequency = VALUES(frequency),
+                        verified = DEFAULT(verified), last_digest_at = NULL
+                ''', (email, token, frequency))
+                conn.commit()
+
+            # Send email verification
+            response = get_client('ses').send_email(
+                Source=os.environ.get('SES_EMAIL'),
+                Destination={
+                    'ToAddresses': [email]
+                },
+                Message={
+                    'Subject': {
+                        'Data': 'NYP Lost and Found Email Verification'
+                    },
+                    'Body': {
+                        'Text': {
+                            'Data': 'Please verify your email by pasting the code below in the NYP Lost and Found website: \n\n' + token
                         }
-                    )
+                    }
+                }
+            )
 
-                    return json.loads(json.dumps({'message': 'Email verification sent'}, default=json_serial))
+            return json_response({'message': 'Email verification sent'})
         else:
             raise BadRequestError("Missing required parameters email")
     else:
@@ -114,17 +190,16 @@ def verify_subscription():
         if email and token:
             sql = "SELECT * FROM email_verifications WHERE email = %s AND token = %s"
 
-            with create_connection().cursor() as cursor:
+            with get_connection() as conn, conn.cursor() as cursor:
                 cursor.execute(sql, (email, token))
                 result = cursor.fetchone()
 
                 if result:
                     # Set email as verified
                     sql = "UPDATE email_verifications SET verified = 1 WHERE email = %s"
-                    with create_connection().cursor() as cursor:
-                        cursor.execute(sql, (email))
+                    cursor.execute(sql, (email))
 
-                    return json.loads(json.dumps({'message': 'Email verified'}, default=json_serial))
+                    return json_response({'message': 'Email verified'})
                 else:
                     raise BadRequestError("Invalid token")
         else:
@@ -133,97 +208,257 @@ def verify_subscription():
         raise BadRequestError("Missing required parameters email")
 
 
-@notification_service.on_sqs_message(queue='lostandfound-queue', batch_size=5)
+def notify_new_items(item_ids, emails=None, attempt=1):
+    """
+    Emails verified subscribers about new items, with one set-based query per table for the whole batch
+    and one email per category. Recipients the email failed for are retried through a delayed SQS message.
+    :param item_ids: Ids of the new items.
+    :param emails: Only notify these subscribers, set when retrying failed recipients.
+    :param attempt: Send attempt of this notification, see MAX_RECIPIENT_ATTEMPTS.
+    :return: Set of item ids whose notification failed as a whole and should be retried.
+    """
+    placeholders = ", ".join(["%s"] * len(item_ids))
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            f"SELECT id, item_name, description, location, found_at, category FROM items WHERE id IN ({placeholders})",
+            list(item_ids)
+        )
+        items = cursor.fetchall()
+
+        missing = set(item_ids) - {item['id'] for item in items}
+        if missing:
+            print(f"No item found for IDs: {sorted(missing)}")
+
+        # Group the items by category id, resolved from the category cache
+        items_by_category = {}
+        for item in items:
+            category_id = get_category_id(item.get('category'))
+            if category_id is None:
+                print(f"No category found for name: {item.get('category')}")
+                continue
+            items_by_category.setdefault(category_id, []).append(item)
+
+        if not items_by_category:
+            return set()
+
+        # Query notification subscribers for all matched categories at once
+        category_ids = list(items_by_category)
+        email_filter = f"AND ns.email IN ({', '.join(['%s'] * len(emails))})" if emails else ""
+        cursor.execute(f'''
+            SELECT ns.categoryId, ns.email FROM notification_subscriptions ns
+            INNER JOIN email_verifications ev ON ns.email = ev.email
+            WHERE ns.categoryId IN ({", ".join(["%s"] * len(category_ids))}) AND ev.verified = 1
+              AND ev.frequency = 'instant' {email_filter}
+        ''', category_ids + list(emails or []))
+        subscribers = cursor.fetchall()
+
+    emails_by_category = {}
+    for subscriber in subscribers:
+        emails_by_category.setdefault(subscriber['categoryId'], []).append(subscriber['email'])
+
+    failed = set()
+    for category_id, category_items in items_by_category.items():
+        category_emails = emails_by_category.get(category_id)
+        if not category_emails:
+            print(f"No subscribers found for category ID: {category_id}")
+            continue
+
+        category_item_ids = [item['id'] for item in category_items]
+        try:
+            failed_emails = send_item_notification(category_emails, category_items)
+            if not failed_emails:
+                continue
+            # Resend only to the recipients that failed, the delivered ones must not get the email twice
+            if attempt >= MAX_RECIPIENT_ATTEMPTS:
+                print(f"Giving up on notifying {failed_emails} about items {category_item_ids}")
+            else:
+                create_recipient_retry(category_item_ids, failed_emails, attempt + 1)
+        except Exception as e:
+            print(f"Failed to notify category {category_id}: {e}")
+            failed.update(category_item_ids)
+
+    return failed
+
+
+def send_item_notification(emails, items):
+    """
+    Emails each subscriber separately about new items.
+    :return: Addresses the email could not be sent to.
+    """
+    print(f"Emails to notify: {emails}")
+    template_data = {
+        'title': 'New Items Added' if len(items) > 1 else 'New Item Added',
+        'items': [
+            {'name': item['item_name'], 'description': item['description'],
+             'location': item['location'], 'found_at': item['found_at']}
+            for item in items
+        ]
+    }
+    outcomes = send_templated_bulk(NEW_ITEMS_TEMPLATE, emails, template_data)
+    return [email for email, outcome in outcomes.items() if outcome['status'] != 'Success']
+
+
+def retry_failed_records(records, failed):
+    """
+    Deletes the records that succeeded and raises, so SQS redelivers only the failed ones.
+    Chalice does not enable ReportBatchItemFailures on the event source mapping.
+    """
+    failed_handles = {record.receipt_handle for record in failed}
+    succeeded = [record for record in records if record.receipt_handle not in failed_handles]
+
+    sqs = get_client('sqs')
+    for start in range(0, len(succeeded), 10):
+        entries = [{'Id': str(index), 'ReceiptHandle': record.receipt_handle}
+                   for index, record in enumerate(succeeded[start:start + 10])]
+        # Retry entries SQS could not delete once, anything left is redelivered and processed again
+        for _ in range(2):
+            response = sqs.delete_message_batch(QueueUrl=os.environ.get('SQS_URL'), Entries=entries)
+            failed_ids = {entry['Id'] for entry in response.get('Failed', [])}
+            entries = [entry for entry in entries if entry['Id'] in failed_ids]
+            if not entries:
+                break
+        for entry in entries:
+            print(f"Error: could not delete processed message {entry['ReceiptHandle']}, it will be redelivered")
+
+    raise RuntimeError(f"{len(failed_handles)} of {len(records)} messages failed and will be retried")
+
+
+@notification_service.on_sqs_message(queue='lostandfound-queue', batch_size=SQS_BATCH_SIZE,
+                                     maximum_batching_window_in_seconds=SQS_BATCHING_WINDOW)
 def handle_sqs_message(event):
     print("Handling SQS message...")
-    for record in event:
+    records = list(event)
+    failed = []
+    item_records = {}
+
+    for record in records:
+        # Parse the record
+        print(f"Raw SQS message: {record.body}")
         try:
-            # Parse the record
-            print(f"Raw SQS message: {record.body}")
             data = json.loads(record.body)
-            print(f"Parsed message: {data}")
-
-            # Check if required fields exist
-            if 'type' not in data or 'id' not in data:
-                print("Error: 'type' or 'id' field missing in message")
-                continue
-
-            item_id = data['id']
-            print(f"Item ID: {item_id}")
-
-            # Query the item by id
-            sql_item = "SELECT * FROM items WHERE id = %s"
-            with create_connection().cursor() as cursor:
-                cursor.execute(sql_item, (item_id,))
-                item = cursor.fetchone()
-
-                if item is None:
-                    print(f"No item found for ID: {item_id}")
-                    continue
-
-                print(f"Item details: {json.dumps(item, default=json_serial)}")
-
-                category_name = item.get('category')
-                if not category_name:
-                    print("Error: 'category' field missing in item")
-                    continue
-                print(f"Category name: {category_name}")
-
-                # Match the category name with the name in the category table
-                sql_category = "SELECT id FROM category WHERE name = %s"
-                cursor.execute(sql_category, (category_name,))
-                category_result = cursor.fetchone()
-
-                if category_result is None:
-                    print(f"No category found for name: {category_name}")
-                    continue
-
-                category_id = category_result['id']
-                print(f"Category ID: {category_id}")
-
-                # Query notification subscribers for the matched category ID
-                sql_subscribers = '''
-                SELECT ns.email FROM notification_subscriptions ns
-                INNER JOIN email_verifications ev ON ns.email = ev.email
-                WHERE ns.categoryId = %s AND ev.verified = 1
-                '''
-                cursor.execute(sql_subscribers, (category_id,))
-                subscribers = cursor.fetchall()
-
-                if not subscribers:
-                    print(f"No subscribers found for category ID: {category_id}")
-                    continue
-
-                print(f"Subscribers: {json.dumps(subscribers, default=json_serial)}")
-
-                emails = [subscriber['email'] for subscriber in subscribers]
-                print(f"Emails to notify: {emails}")
-
-                # Send email to users
-                if emails:
-                    response = ses.send_email(
-                        Source=os.environ.get('SES_EMAIL'),
-                        Destination={'ToAddresses': emails},
-                        Message={
-                            'Subject': {'Data': 'Lost and Found Notification - New Item Added'},
-                            'Body': {
-                                'Text': {
-                                    'Data': (
-                                        f"New item added to category:\n\n"
-                                        f"Name: {item['item_name']}\n"
-                                        f"Description: {item['description']}\n"
-                                        f"Location: {item['location']}\n"
-                                        f"Found at: {item['found_at']}\n\n"
-                                        "Please check the NYP Lost and Found website for more details: "
-                                        "https://main.dthcvv5pro4em.amplifyapp.com/\n"
-                                    )
-                                }
-                            }
-                        }
-                    )
-                    print(f"SES response: {response}")
-                    for email in emails:
-                        print(f'Email sent to: {email}')
-
+        except ValueError:
+            # Malformed messages would fail again, do not retry them
+            print("Error: message body is not valid JSON")
+            continue
+
+        if data.get('type') == 'recipients':
+            # Resend of a notification to the recipients it failed for
+            try:
+                if notify_new_items(data['ids'], emails=data['emails'], attempt=data['attempt']):
+                    failed.append(record)
+            except Exception as e:
+                print(f"Error resending notification for items {data.get('ids')}: {e}")
+                failed.append(record)
+            continue
+
+        # Check if required fields exist
+        if 'type' not in data or 'id' not in data:
+            print("Error: 'type' or 'id' field missing in message")
+            continue
+
+        if data['type'] == 'derivatives':
+            try:
+                fill_item_derivatives(data['id'])
+            except Exception as e:
+                print(f"Error generating derivatives for item {data['id']}: {e}")
+                failed.append(record)
+            continue
+
+        if data['type'] == 'labels':
+            # Label enrichment job, subscribers are notified once the category is known. A retry after the labels
+            # were committed still notifies, a failed create_notification is what caused the retry
+            try:
+                fill_item_derivatives(data['id'])
+                if enrich_item_labels(data['id']):
+                    create_notification(data['id'])
+            except Exception as e:
+                print(f"Error enriching item {data['id']}: {e}")
+                failed.append(record)
+            continue
+
+        item_records.setdefault(data['id'], []).append(record)
+
+    if item_records:
+        try:
+            failed_ids = notify_new_items(list(item_records))
         except Exception as e:
-            print(f"Error handling message: {e}")
+            print(f"Error handling messages: {e}")
+            failed_ids = set(item_records)
+        for item_id in failed_ids:
+            failed.extend(item_records[item_id])
+
+    if failed:
+        retry_failed_records(records, failed)
+
+
+def send_digests(frequency):
+    """
+    Emails every verified subscriber with the given frequency one summary of the items added to any of their
+    categories since their previous digest, collected with a single query. Items count from when their labels
+    were settled, so an item still being labeled during one run is included in the next. Each digest lists at
+    most MAX_DIGEST_ITEMS of them.
+    :return: Number of digests sent.
+    """
+    run_started_at = datetime.utcnow().replace(microsecond=0)
+    first_window_start = run_started_at - NOTIFICATION_FREQUENCIES[frequency]
+
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('''
+            SELECT email, item_name, description, location, found_at, category, total
+            FROM (
+                SELECT ev.email, i.item_name, i.description, i.location, i.found_at, i.category, i.labeled_at,
+                       ROW_NUMBER() OVER (PARTITION BY ev.email ORDER BY i.labeled_at DESC, i.id DESC) AS position,
+                       COUNT(*) OVER (PARTITION BY ev.email) AS total
+                FROM email_verifications ev
+                INNER JOIN notification_subscriptions ns ON ns.email = ev.email
+                INNER JOIN category c ON c.id = ns.categoryId
+                INNER JOIN items i ON i.category = c.name
+                WHERE ev.frequency = %s AND ev.verified = 1
+                  AND i.labeled_at > COALESCE(ev.last_digest_at, %s) AND i.labeled_at <= %s
+            ) digest_items
+            WHERE position <= %s
+            ORDER BY email, labeled_at
+        ''', (frequency, first_window_start, run_started_at, MAX_DIGEST_ITEMS))
+        rows = cursor.fetchall()
+
+    items_by_email = {}
+    totals = {}
+    for row in rows:
+        totals[row['email']] = row['total']
+        items_by_email.setdefault(row['email'], []).append({
+            'name': row['item_name'], 'description': row['description'], 'location': row['location'],
+            'found_at': row['found_at'], 'category': row['category']
+        })
+
+    failed = []
+    if items_by_email:
+        outcomes = send_templated_bulk(
+            DIGEST_TEMPLATE, list(items_by_email), {'title': 'New Items', 'items': []},
+            recipient_data={email: {'title': f"{totals[email]} New Item{'s' if totals[email] > 1 else ''}",
+                                    'items': items}
+                            for email, items in items_by_email.items()}
+        )
+        failed = [email for email, outcome in outcomes.items() if outcome['status'] != 'Success']
+
+    # Move every subscriber's window forward, except for those whose digest failed so they get it next run
+    with get_connection() as conn, conn.cursor() as cursor:
+        sql = "UPDATE email_verifications SET last_digest_at = %s WHERE frequency = %s AND verified = 1"
+        args = [run_started_at, frequency]
+        if failed:
+            sql += f" AND email NOT IN ({', '.join(['%s'] * len(failed))})"
+            args.extend(failed)
+        cursor.execute(sql, args)
+
+    print(f"Sent {len(items_by_email) - len(failed)} {frequency} digests")
+    return len(items_by_email) - len(failed)
+
+
+@notification_service.schedule(Rate(1, unit=Rate.HOURS))
+def send_hourly_digests(event):
+    send_digests('hourly')
+
+
+# 00:00 UTC is 08:00 in Singapore
+@notification_service.schedule(Cron(0, 0, '*', '*', '?', '*'))
+def send_daily_digests(event):
+    send_digests('daily')
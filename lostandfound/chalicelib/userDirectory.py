@@ -0,0 +1,90 @@
+import json
+import os
+from datetime import datetime
+from .connectHelper import get_connection
+from .lazyRegistry import get_client
+
+pool_id = os.environ.get('USER_POOL_ID')
+
+MIRRORED_ATTRIBUTES = ['email', 'name', 'phone_number', 'birthdate']
+
+# Rows written per INSERT during reconciliation
+UPSERT_BATCH_SIZE = 200
+
+SQL_UPSERT_PREFIX = """
+    INSERT INTO users (username, email, name, phone_number, birthdate, enabled, user_status, `groups`,
+                       created_at, modified_at, synced_at)
+    VALUES
+"""
+SQL_UPSERT_SUFFIX = """
+    ON DUPLICATE KEY UPDATE
+        email = VALUES(email), name = VALUES(name), phone_number = VALUES(phone_number),
+        birthdate = VALUES(birthdate), enabled = VALUES(enabled), user_status = VALUES(user_status),
+        `groups` = VALUES(`groups`), modified_at = VALUES(modified_at), synced_at = VALUES(synced_at)
+"""
+
+
+def _row(user, attributes, groups, synced_at):
+    values = {a["Name"]: a["Value"] for a in attributes}
+    return (
+        user["Username"], *[values.get(name) for name in MIRRORED_ATTRIBUTES], user["Enabled"],
+        user["UserStatus"], json.dumps(sorted(groups)),
+        user["UserCreateDate"], user["UserLastModifiedDate"], synced_at
+    )
+
+
+def _upsert(cursor, rows):
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        batch = rows[start:start + UPSERT_BATCH_SIZE]
+        placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(batch))
+        cursor.execute(SQL_UPSERT_PREFIX + placeholders + SQL_UPSERT_SUFFIX, [value for row in batch for value in row])
+
+
+def sync_user(username):
+    """Refreshes one user's mirror row from Cognito, or removes it if the user no longer exists."""
+    idp_client = get_client('cognito-idp')
+    try:
+        user = idp_client.admin_get_user(UserPoolId=pool_id, Username=username)
+    except idp_client.exceptions.UserNotFoundException:
+        with get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("DELETE FROM users WHERE username = %s", (username,))
+        return
+
+    groups = idp_client.admin_list_groups_for_user(UserPoolId=pool_id, Username=username)["Groups"]
+    row = _row(user, user["UserAttributes"], [group["GroupName"] for group in groups], datetime.utcnow())
+
+    with get_connection() as conn, conn.cursor() as cursor:
+        _upsert(cursor, [row])
+
+
+def reconcile_users():
+    """
+    Rebuilds the mirror from a full walk of the user pool and deletes users that no longer exist.
+    Group membership is read per group, which takes a handful of calls instead of one per user.
+    :return: Number of users mirrored.
+    """
+    idp_client = get_client('cognito-idp')
+    synced_at = datetime.utcnow().replace(microsecond=0)
+
+    user_groups = {}
+    for page in idp_client.get_paginator('list_groups').paginate(UserPoolId=pool_id):
+        for group in page["Groups"]:
+            pages = idp_client.get_paginator('list_users_in_group').paginate(UserPoolId=pool_id, GroupName=group["GroupName"])
+            for members in pages:
+                for member in members["Users"]:
+                    user_groups.setdefault(member["Username"], []).append(group["GroupName"])
+
+    rows = []
+    for page in idp_client.get_paginator('list_users').paginate(UserPoolId=pool_id):
+        for user in page["Users"]:
+            rows.append(_row(user, user["Attributes"], user_groups.get(user["Username"], []), synced_at))
+
+    with get_connection() as conn, conn.cursor() as cursor:
+        conn.begin()
+        _upsert(cursor, rows)
+        # Anything not touched by this run was deleted from Cognito
+        cursor.execute("DELETE FROM users WHERE synced_at < %s", (synced_at,))
+        conn.commit()
+
+    print(f"Mirrored {len(rows)} users")
+    return len(rows)
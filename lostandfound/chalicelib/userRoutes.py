@@ -1,71 +1,146 @@
 import os
-from chalice import Blueprint, BadRequestError
-import boto3
+from chalice import Blueprint, BadRequestError, Rate
 import json
+import re
 from .authorizers import admin_authorizer
+from .connectHelper import get_connection
+from .helpers import json_response, map_concurrently
+from .lazyRegistry import get_client
+from .userDirectory import sync_user, reconcile_users
 from strgen import StringGenerator as SG
 
 user_routes = Blueprint(__name__)
-idp_client = boto3.client('cognito-idp')
 
 pool_id = os.environ.get('USER_POOL_ID')
 
+# Largest page Cognito's list_users returns
+MAX_USERS_PAGE_SIZE = 60
 
-@user_routes.route('/admin/users', authorizer=admin_authorizer, cors=True, methods=['GET'])
-def get_users():
-    users = idp_client.list_users(
-        UserPoolId=pool_id,
-        AttributesToGet=[
-            'name',
-            'phone_number',
-            'email'
-        ]
-    )["Users"]
-
-    output_users = []
+# Local directory listing: sortable columns and largest page
+DIRECTORY_SORT_COLUMNS = {'username': 'username', 'email': 'email', 'name': 'name', 'created_at': 'created_at'}
+MAX_DIRECTORY_PAGE_SIZE = 200
 
-    for user in users:
-        output_user = {"username": user["Username"], "create_at": user["UserCreateDate"],
-                       "modified_at": user["UserLastModifiedDate"], "enabled": user["Enabled"],
-                       "user_status": user["UserStatus"]}
+# Users accepted by one /admin/users/batch request
+MAX_BATCH_USERS = 100
 
-        for a in user["Attributes"]:
-            output_user[a["Name"]] = a["Value"]
 
-        output_users.append(output_user)
+def format_user(user, attributes):
+    output_user = {"username": user["Username"], "create_at": user["UserCreateDate"],
+                   "modified_at": user["UserLastModifiedDate"], "enabled": user["Enabled"],
+                   "user_status": user["UserStatus"]}
 
-    return json.loads(json.dumps(output_users, default=str))
+    for a in attributes:
+        output_user[a["Name"]] = a["Value"]
 
+    return output_user
 
-@user_routes.route('/admin/users/{username}', cors=True, methods=['GET'])
-def get_user(username):
-    user = idp_client.admin_get_user(
-        UserPoolId=pool_id,
-        Username=username
-    )
 
-    user_groups = idp_client.admin_list_groups_for_user(
+def list_groups(username):
+    groups = get_client('cognito-idp').admin_list_groups_for_user(
         Username=username,
         UserPoolId=pool_id
     )["Groups"]
+    return [group["GroupName"] for group in groups]
 
-    output_user = {"username": user["Username"], "create_at": user["UserCreateDate"],
-                   "modified_at": user["UserLastModifiedDate"], "enabled": user["Enabled"],
-                   "user_status": user["UserStatus"]}
 
-    for a in user["UserAttributes"]:
-        output_user[a["Name"]] = a["Value"]
+def sync_mirror(username):
+    # The local directory is a cache, a failed sync is repaired by the next reconcile_users run
+    try:
+        sync_user(username)
+    except Exception as e:
+        print(f"Failed to sync user {username} to the local directory: {e}")
 
-    output_user["groups"] = [group["GroupName"] for group in user_groups]
 
-    return json.loads(json.dumps(output_user, default=str))
+@user_routes.route('/admin/users', authorizer=admin_authorizer, cors=True, methods=['GET'])
+def get_users():
+    idp_client = get_client('cognito-idp')
+    params = user_routes.current_request.query_params or {}
+
+    # Cognito accepts a single filter expression, email prefix takes precedence over status
+    filters = []
+    for param, attribute, operator in [('email', 'email', '^='), ('status', 'cognito:user_status', '=')]:
+        value = params.get(param)
+        if value:
+            if '"' in value or '\\' in value:
+                raise BadRequestError(f"Invalid {param} filter")
+            filters.append((attribute, operator, value))
+
+    request_args = {
+        'UserPoolId': pool_id,
+        'AttributesToGet': [
+            'name',
+            'phone_number',
+            'email'
+        ]
+    }
+    if filters:
+        attribute, operator, value = filters[0]
+        request_args['Filter'] = f'{attribute} {operator} "{value}"'
+
+    paginated = 'limit' in params or 'cursor' in params
+    include_groups = params.get('include_groups') == 'true'
+    # Groups cost one Cognito call per user, so they are only offered for a single bounded page
+    if include_groups and not paginated:
+        raise BadRequestError("include_groups requires limit or cursor")
+    if paginated:
+        try:
+            limit = int(params.get('limit', MAX_USERS_PAGE_SIZE))
+        except ValueError:
+            raise BadRequestError("limit must be a number")
+        request_args['Limit'] = max(1, min(limit, MAX_USERS_PAGE_SIZE))
+        if params.get('cursor'):
+            request_args['PaginationToken'] = params['cursor']
+
+    users = []
+    next_cursor = None
+    while True:
+        response = idp_client.list_users(**request_args)
+        users.extend(response["Users"])
+        next_cursor = response.get("PaginationToken")
+
+        # A page was requested, or there is nothing left to walk
+        if paginated or not next_cursor:
+            break
+        request_args['PaginationToken'] = next_cursor
+
+    output_users = [format_user(user, user["Attributes"]) for user in users]
+
+    # Status is the only filter that can come second, apply it to the returned users
+    for attribute, _, value in filters[1:]:
+        output_users = [user for user in output_users if user["user_status"] == value]
+
+    if include_groups:
+        # Fetch group membership for the whole page at once instead of one request per row
+        for output_user, groups in zip(output_users, map_concurrently(list_groups, [u["username"] for u in output_users])):
+            output_user["groups"] = groups
+
+    if paginated:
+        return json_response({"users": output_users, "next_cursor": next_cursor}, default=str)
+    return json_response(output_users, default=str)
 
 
-@user_routes.route('/admin/users/{username}', authorizer=admin_authorizer, cors=True, methods=['PUT'])
-def update_user(username):
-    request = user_routes.current_request
-    body = request.json_body
-    group = body["group"]
+@user_routes.route('/admin/users/{username}', cors=True, methods=['GET'])
+def get_user(username):
+    idp_client = get_client('cognito-idp')
+
+    # The user and its groups are independent lookups, issue them together
+    user, groups = map_concurrently(lambda lookup: lookup(), [
+        lambda: idp_client.admin_get_user(UserPoolId=pool_id, Username=username),
+        lambda: list_groups(username)
+    ])
+
+    output_user = format_user(user, user["UserAttributes"])
+    output_user["groups"] = groups
+
+    return json_response(output_user, default=str)
+
+
+def apply_user_changes(username, body):
+    """
+    Updates a user's attributes and, if body has a "group", moves the user to exactly that group.
+    Independent Cognito calls are issued concurrently and group changes are applied as a diff.
+    """
+    idp_client = get_client('cognito-idp')
     userAttributes = []
 
     for key in body:
@@ -80,41 +155,68 @@ def update_user(username):
             'Value': body[key]
         })
 
-    user = idp_client.admin_update_user_attributes(
-        UserPoolId=pool_id,
-        Username=username,
-        UserAttributes=userAttributes
-    )
+    calls = []
+    if userAttributes:
+        calls.append(lambda: idp_client.admin_update_user_attributes(
+            UserPoolId=pool_id,
+            Username=username,
+            UserAttributes=userAttributes
+        ))
+    if "group" in body:
+        calls.append(lambda: list_groups(username))
+    results = map_concurrently(lambda call: call(), calls)
 
-    # Update user groups
-    groups = idp_client.admin_list_groups_for_user(
-        Username=username,
-        UserPoolId=pool_id
-    )["Groups"]
+    if "group" in body:
+        # Only "admin" is an actual Cognito group, "normal" means no group
+        current_groups = set(results[-1])
+        desired_groups = {body["group"]} if body["group"] in ["admin"] else set()
 
-    for g in groups:
-        # check if user is in the group
-        if g["GroupName"] == group:
-            return {"message": "User updated successfully"}
+        changes = [(idp_client.admin_remove_user_from_group, g) for g in current_groups - desired_groups]
+        changes += [(idp_client.admin_add_user_to_group, g) for g in desired_groups - current_groups]
+        map_concurrently(lambda change: change[0](UserPoolId=pool_id, Username=username, GroupName=change[1]), changes)
 
-        idp_client.admin_remove_user_from_group(
-            UserPoolId=pool_id,
-            Username=username,
-            GroupName=g["GroupName"]
-        )
+    sync_mirror(username)
 
-    if group != "normal" and (group in ["admin"]):
-        group_res = idp_client.admin_add_user_to_group(
-            UserPoolId=pool_id,
-            Username=username,
-            GroupName=group
-        )
 
+@user_routes.route('/admin/users/{username}', authorizer=admin_authorizer, cors=True, methods=['PUT'])
+def update_user(username):
+    request = user_routes.current_request
+    body = request.json_body
+    if "group" not in body:
+        raise BadRequestError("group is required")
+
+    apply_user_changes(username, body)
     return {"message": "User updated successfully"}
 
 
+@user_routes.route('/admin/users/batch', authorizer=admin_authorizer, cors=True, methods=['POST'])
+def batch_update_users():
+    """
+    Applies attribute and group changes to many users in one request.
+    Body: {"users": [{"username": ..., "group": ..., "name": ...}, ...]}
+    """
+    body = user_routes.current_request.json_body or {}
+    changes = body.get("users")
+    if not isinstance(changes, list) or not changes or len(changes) > MAX_BATCH_USERS:
+        raise BadRequestError(f"users must be a list of 1 to {MAX_BATCH_USERS} entries")
+
+    def apply(change):
+        username = change.get("username") if isinstance(change, dict) else None
+        if not username:
+            return {"username": username, "status": "error", "message": "username is required"}
+        try:
+            apply_user_changes(username, {key: value for key, value in change.items() if key != "username"})
+            return {"username": username, "status": "updated"}
+        except Exception as e:
+            return {"username": username, "status": "error", "message": str(e)}
+
+    results = map_concurrently(apply, changes)
+    return {"results": results, "failed": sum(1 for result in results if result["status"] == "error")}
+
+
 @user_routes.route('/admin/users', authorizer=admin_authorizer, cors=True, methods=['POST'])
 def create_user():
+    idp_client = get_client('cognito-idp')
     request = user_routes.current_request
     body = request.json_body
 
@@ -152,4 +254,60 @@ def create_user():
             GroupName=group
         )
 
-    return {"message": "User created successfully"}
\ No newline at end of file
+    sync_mirror(username)
+    return {"message": "User created successfully"}
+
+@user_routes.route('/admin/directory', authorizer=admin_authorizer, cors=True, methods=['GET'])
+def search_directory():
+    """Lists, sorts and searches users from the local mirror instead of Cognito."""
+    params = user_routes.current_request.query_params or {}
+
+    sort = params.get('sort', 'username')
+    if sort not in DIRECTORY_SORT_COLUMNS:
+        raise BadRequestError(f"sort must be one of {', '.join(DIRECTORY_SORT_COLUMNS)}")
+    order = params.get('order', 'asc').lower()
+    if order not in ('asc', 'desc'):
+        raise BadRequestError("order must be 'asc' or 'desc'")
+    try:
+        limit = max(1, min(int(params.get('limit', MAX_USERS_PAGE_SIZE)), MAX_DIRECTORY_PAGE_SIZE))
+        offset = max(0, int(params.get('offset', 0)))
+    except ValueError:
+        raise BadRequestError("limit and offset must be numbers")
+
+    conditions = []
+    args = []
+    if params.get('q'):
+        # Prefix matches so the username/email/name indexes can be used
+        prefix = re.sub(r'([%_\\])', r'\\\1', params['q']) + '%'
+        conditions.append("(username LIKE %s OR email LIKE %s OR name LIKE %s)")
+        args.extend([prefix, prefix, prefix])
+    if params.get('status'):
+        conditions.append("user_status = %s")
+        args.append(params['status'])
+    if params.get('group'):
+        conditions.append("JSON_CONTAINS(`groups`, JSON_QUOTE(%s))")
+        args.append(params['group'])
+
+    sql = f"""
+        SELECT *
+        FROM users
+        {"WHERE " + " AND ".join(conditions) if conditions else ""}
+        ORDER BY {DIRECTORY_SORT_COLUMNS[sort]} {order.upper()}, username {order.upper()}
+        LIMIT %s OFFSET %s
+    """
+    args.extend([limit, offset])
+
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(sql, args)
+        users = cursor.fetchall()
+
+    for user in users:
+        user["enabled"] = bool(user["enabled"])
+        user["groups"] = json.loads(user["groups"] or '[]')
+
+    return json_response({"users": users, "offset": offset, "limit": limit}, default=str)
+
+
+@user_routes.schedule(Rate(1, unit=Rate.HOURS))
+def reconcile_user_directory(event):
+    reconcile_users()
@@ -0,0 +1,7 @@
+-- Indexes backing keyset pagination and filtering on GET /items.
+-- Every index ends in (found_at, id) so filtered pages can be read in order without a filesort.
+
+CREATE INDEX idx_items_found_at_id ON items (found_at, id);
+CREATE INDEX idx_items_status_found_at_id ON items (status, found_at, id);
+CREATE INDEX idx_items_category_found_at_id ON items (category, found_at, id);
+CREATE INDEX idx_items_brand_found_at_id ON items (brand, found_at, id);
@@ -0,0 +1,9 @@
+-- FULLTEXT index backing GET /items/search.
+-- labels holds the Rekognition labels as JSON, a stored generated column exposes it as plain text
+-- so it can take part in the same index as the other searchable columns. It is INVISIBLE (MySQL 8.0.23+)
+-- so existing SELECT * queries do not return it.
+
+ALTER TABLE items
+    ADD COLUMN labels_text TEXT GENERATED ALWAYS AS (CAST(labels AS CHAR)) STORED INVISIBLE;
+
+CREATE FULLTEXT INDEX ft_items_search ON items (item_name, description, location, brand, labels_text);
@@ -0,0 +1,6 @@
+-- Resized derivatives stored next to each original image.
+-- Both columns hold JSON arrays parallel to image_url, with null where a derivative could not be generated.
+
+ALTER TABLE items
+    ADD COLUMN thumbnail_url TEXT NULL AFTER image_url,
+    ADD COLUMN medium_url TEXT NULL AFTER thumbnail_url;
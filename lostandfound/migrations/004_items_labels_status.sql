@@ -0,0 +1,5 @@
+-- Tracks whether Rekognition labels have been filled in, items created with ASYNC_LABELING=true
+-- start as 'pending' until the SQS worker has labeled them.
+
+ALTER TABLE items
+    ADD COLUMN labels_status VARCHAR(16) NOT NULL DEFAULT 'done';
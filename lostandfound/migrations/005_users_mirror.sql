@@ -0,0 +1,20 @@
+-- Local mirror of the Cognito user pool, kept in sync by the admin user routes and the hourly
+-- reconcile_users job. Serves admin listing, sorting and search without calling Cognito.
+
+CREATE TABLE users (
+    username     VARCHAR(128) NOT NULL PRIMARY KEY,
+    email        VARCHAR(255) NULL,
+    name         VARCHAR(255) NULL,
+    phone_number VARCHAR(32)  NULL,
+    birthdate    VARCHAR(16)  NULL,
+    enabled      TINYINT(1)   NOT NULL DEFAULT 1,
+    user_status  VARCHAR(32)  NOT NULL,
+    `groups`     TEXT         NULL,
+    created_at   DATETIME     NOT NULL,
+    modified_at  DATETIME     NOT NULL,
+    synced_at    DATETIME     NOT NULL,
+    INDEX idx_users_email (email),
+    INDEX idx_users_name (name),
+    INDEX idx_users_created_at (created_at),
+    INDEX idx_users_synced_at (synced_at)
+);
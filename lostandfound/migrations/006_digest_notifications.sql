@@ -0,0 +1,11 @@
+-- Digest notifications: subscribers pick instant, hourly or daily emails, and items record when they were
+-- created so each digest covers exactly the items added since the subscriber's previous one.
+
+ALTER TABLE email_verifications
+    ADD COLUMN frequency VARCHAR(16) NOT NULL DEFAULT 'instant',
+    ADD COLUMN last_digest_at DATETIME NULL,
+    ADD INDEX idx_email_verifications_frequency (frequency, verified);
+
+ALTER TABLE items
+    ADD COLUMN created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    ADD INDEX idx_items_created_at (created_at);
@@ -0,0 +1,26 @@
+-- create_subscription upserts the verification token with ON DUPLICATE KEY UPDATE, which needs email to be unique.
+
+-- The old delete-then-insert code ran over several autocommit connections and could leave several rows per email.
+-- Keep one row per email. The table has no timestamp to find the newest token by, so rows are ranked on their
+-- own columns, which gives the same result on every run: a verified row wins so no subscriber loses verification,
+-- then the most recently digested one, then the highest token. A pending subscriber whose link stops working
+-- can subscribe again.
+CREATE TEMPORARY TABLE email_verifications_keep AS
+    SELECT email, token
+    FROM (
+        SELECT email, token,
+               ROW_NUMBER() OVER (
+                   PARTITION BY email ORDER BY verified DESC, last_digest_at DESC, token DESC
+               ) AS kept_first
+        FROM email_verifications
+    ) AS ranked
+    WHERE kept_first = 1;
+
+DELETE ev FROM email_verifications ev
+    LEFT JOIN email_verifications_keep kept ON kept.email = ev.email AND kept.token = ev.token
+    WHERE kept.email IS NULL;
+
+DROP TEMPORARY TABLE email_verifications_keep;
+
+ALTER TABLE email_verifications
+    ADD UNIQUE INDEX uq_email_verifications_email (email);
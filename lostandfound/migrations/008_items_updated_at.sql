@@ -0,0 +1,5 @@
+-- Items record when they last changed. MySQL maintains the column on every UPDATE, whichever code path
+-- runs it, and it drives the ETag/Last-Modified validators of /item/{id} and /items.
+
+ALTER TABLE items
+    ADD COLUMN updated_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6);
@@ -0,0 +1,9 @@
+-- Records when an item's labels (and so its final category) were settled. Digests select items by this time
+-- rather than created_at, so items labeled by the SQS worker after a digest run still make the next digest.
+-- Existing items are left NULL: created_at holds the time migration 006 ran for most of them, so backfilling
+-- from it would put the whole history into the first digest. Those items were already sent as instant
+-- notifications and never appear in a digest.
+
+ALTER TABLE items
+    ADD COLUMN labeled_at DATETIME NULL,
+    ADD INDEX idx_items_labeled_at (labeled_at);